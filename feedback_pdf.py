@@ -0,0 +1,77 @@
+"""
+Renders the consultation feedback PDF served by /download_feedback. It lives outside main.py and
+imports nothing but ReportLab, so it can be rendered (and benchmarked) without the app's side
+effects (database, scheduler, Stripe).
+"""
+import io
+from xml.sax.saxutils import escape
+
+from reportlab.lib import colors
+from reportlab.lib.enums import TA_LEFT
+from reportlab.lib.pagesizes import letter
+from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, ListFlowable, ListItem
+
+# Bump when the layout changes so cached PDFs are not served in the old layout
+LAYOUT_VERSION = 1
+
+# Built once per process rather than on every download
+_styles = getSampleStyleSheet()
+TITLE_STYLE = ParagraphStyle(
+    name='Title',
+    parent=_styles['Title'],
+    fontName='Helvetica-Bold',
+    fontSize=14,
+    alignment=TA_LEFT,
+    textColor=colors.black,
+    spaceAfter=12
+)
+BULLET_STYLE = ParagraphStyle(
+    name='Bullet',
+    parent=_styles['Normal'],
+    fontName='Helvetica',
+    fontSize=11,
+    leading=14,
+    leftIndent=20,
+    spaceBefore=4,
+    spaceAfter=4
+)
+FALLBACK_STYLE = ParagraphStyle(
+    name='Fallback',
+    parent=_styles['Normal'],
+    fontName='Courier',
+    fontSize=10,
+    leading=12
+)
+
+
+def bullet(text):
+    return ListItem(Paragraph(text, BULLET_STYLE), bulletSymbol="•")
+
+
+def render(feedback_dict, raw_feedback, categories):
+    """
+    Return the PDF bytes for a report. `categories` is a sequence of (key, label) pairs for the
+    scored categories of `feedback_dict`; `raw_feedback` is used when there is no structured report.
+    """
+    pdf_buffer = io.BytesIO()
+    doc = SimpleDocTemplate(pdf_buffer, pagesize=letter)
+    story = [Paragraph("Consultation Feedback", TITLE_STYLE), Spacer(1, 8)]
+    if feedback_dict:
+        bullet_items = []
+        for key, label in categories:
+            entry = feedback_dict[key]
+            bullet_items.append(bullet(
+                f"<b>{escape(label)}:</b> Score: {entry['score']}, Comment: {escape(str(entry['comment']))}"
+            ))
+        bullet_items.append(bullet(f"<b>Overall Score:</b> {feedback_dict['overall']}/70"))
+        if feedback_dict.get("clinical_reasoning"):
+            bullet_items.append(bullet(
+                f"<b>Clinical Reasoning &amp; Bias Analysis:</b> {escape(str(feedback_dict['clinical_reasoning']))}"
+            ))
+        story.append(ListFlowable(bullet_items, bulletType='bullet', start=None))
+    else:
+        story.append(Paragraph("Raw Feedback:", TITLE_STYLE))
+        story.append(Paragraph(escape(raw_feedback), FALLBACK_STYLE))
+    doc.build(story)
+    return pdf_buffer.getvalue()
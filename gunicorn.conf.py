@@ -0,0 +1,44 @@
+# Gunicorn configuration (picked up automatically when gunicorn is started from this directory)
+import os
+
+# ASYNC_WORKERS=true serves each request on a gevent greenlet, so a request waiting on OpenAI
+# (or streaming a reply) yields to other requests instead of holding a whole worker process.
+# Set ASYNC_WORKERS=false to fall back to plain sync workers.
+ASYNC_WORKERS = os.getenv("ASYNC_WORKERS", "true").lower() == "true"
+
+if ASYNC_WORKERS:
+    worker_class = "gevent"
+    # Concurrent requests (e.g. consultations waiting on the model) each worker will accept
+    worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "500"))
+else:
+    worker_class = "sync"
+
+
+def on_starting(server):
+    # The identity cache holds each user's session token, admin flag and subscription status. With
+    # the per-process "simple" cache, a change made in one worker would go unnoticed by the others
+    # for up to IDENTITY_CACHE_SECONDS, so several workers must share the filesystem cache.
+    if server.cfg.workers <= 1:
+        return
+    backend = os.getenv("CACHE_BACKEND")
+    if backend is None and not server.cfg.preload_app:
+        os.environ["CACHE_BACKEND"] = "filesystem"
+        server.log.info("Using CACHE_BACKEND=filesystem so the %s workers share one cache", server.cfg.workers)
+    elif backend in (None, "simple"):
+        # With preload_app the app (and its caches) is already loaded by the time this runs
+        raise RuntimeError(
+            f"{server.cfg.workers} workers need a shared cache: set CACHE_BACKEND=filesystem "
+            "(CACHE_BACKEND=simple keeps a separate identity cache in every worker)"
+        )
+
+
+def post_fork(server, worker):
+    if not ASYNC_WORKERS:
+        return
+    # psycopg2 talks to Postgres in C, so gevent's monkey patching can't make it yield on its own
+    try:
+        from psycogreen.gevent import patch_psycopg
+    except ImportError:
+        server.log.warning("psycogreen is not installed; database queries will block the gevent worker")
+    else:
+        patch_psycopg()
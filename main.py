@@ -3,32 +3,43 @@ import io
 import random
 import time
 import json  # for parsing JSON responses from the API
+import ast
 import re  # for password complexity validation & optional post-processing
 import uuid  # for generating unique session tokens
-import statistics  # for computing median weighted cost
+import collections
+import atexit
+import threading
+import socket
+import functools
+import hashlib
 from datetime import datetime
-from flask import Flask, render_template, redirect, url_for, request, flash, session, send_file, jsonify, Blueprint
+from flask import Flask, render_template, redirect, url_for, request, flash, session, send_file, jsonify, Blueprint, \
+    Response, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
 from sqlalchemy.exc import IntegrityError
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
 from dotenv import load_dotenv
 import openai
+import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 import stripe
-from reportlab.lib.pagesizes import letter
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Preformatted
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from flask_migrate import Migrate
 from itsdangerous import URLSafeTimedSerializer, SignatureExpired, BadSignature
 from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.executors.pool import ThreadPoolExecutor as JobThreadPool
 import smtplib
 from email.mime.text import MIMEText  # For sending emails via SMTP
 from flask_session import Session
+from cachelib import SimpleCache, FileSystemCache
 from datetime import timedelta  # add this at the top with your other imports
 import logging
 from email.utils import format_datetime
 import pytz
+import feedback_pdf
 
 # Configure logging (you can place this near the top of your file, after imports)
 logging.basicConfig(
@@ -73,6 +84,8 @@ def validate_password(password):
 # Configure Stripe
 stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
 STRIPE_PRICE_ID = os.getenv("STRIPE_PRICE_ID")  # e.g., for £3.99/month
+STRIPE_WEBHOOK_SECRET = os.getenv("STRIPE_WEBHOOK_SECRET")  # signing secret of the /stripe/webhook endpoint
+TRIAL_PERIOD = timedelta(hours=1)
 
 
 # Set up model pricing (per 1M tokens) from environment
@@ -80,6 +93,429 @@ GPT4_INPUT_COST_PER_1M = float(os.getenv("GPT4_INPUT_COST_PER_1M", "10.00"))
 GPT4_OUTPUT_COST_PER_1M = float(os.getenv("GPT4_OUTPUT_COST_PER_1M", "30.00"))
 GPT35_INPUT_COST_PER_1M = float(os.getenv("GPT35_INPUT_COST_PER_1M", "0.50"))
 GPT35_OUTPUT_COST_PER_1M = float(os.getenv("GPT35_OUTPUT_COST_PER_1M", "1.50"))
+MODEL_COSTS_PER_1M = {
+    "gpt-4-turbo": (GPT4_INPUT_COST_PER_1M, GPT4_OUTPUT_COST_PER_1M),
+    "gpt-3.5-turbo": (GPT35_INPUT_COST_PER_1M, GPT35_OUTPUT_COST_PER_1M),
+}
+
+
+def token_cost(model, prompt_tokens, completion_tokens):
+    input_cost, output_cost = MODEL_COSTS_PER_1M.get(model, (0.0, 0.0))
+    return (prompt_tokens or 0) / 1_000_000 * input_cost + (completion_tokens or 0) / 1_000_000 * output_cost
+
+# Stream patient replies to the browser as Server-Sent Events (set to "false" to always return one JSON blob)
+STREAM_REPLIES = os.getenv("STREAM_REPLIES", "true").lower() == "true"
+
+
+# --- Token Estimation ---
+# Prompt sizes are estimated locally before every OpenAI call (and streamed completions, which
+# report no usage, are billed from the estimate). tiktoken is used when it is installed and its
+# encodings are cached; otherwise words and punctuation are counted, erring slightly high.
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+_token_encodings = {}
+
+
+def _get_encoding(model):
+    if tiktoken is None or not model:
+        return None
+    if model not in _token_encodings:
+        try:
+            _token_encodings[model] = tiktoken.encoding_for_model(model)
+        except Exception as e:
+            logging.debug(f"tiktoken unavailable for {model}, using estimate: {e}")
+            _token_encodings[model] = None
+    return _token_encodings[model]
+
+
+def estimate_tokens(text, model=None):
+    if not text:
+        return 0
+    encoding = _get_encoding(model)
+    if encoding is not None:
+        return len(encoding.encode(text))
+    # Short words are usually one token; longer ones split roughly every four characters
+    return sum(1 + (len(piece) - 1) // 4 for piece in TOKEN_PATTERN.findall(text))
+
+
+def estimate_message_tokens(messages, model=None):
+    # Each chat message carries a few tokens of framing on top of its content
+    return sum(estimate_tokens(m.get('content', ''), model) + 4 for m in messages) + 2
+
+
+def trim_messages(messages, budget, model=None):
+    """Drop the oldest non-system messages until the prompt fits `budget` (always keeping the latest)."""
+    trimmed = list(messages)
+    while estimate_message_tokens(trimmed, model) > budget:
+        droppable = [i for i, m in enumerate(trimmed[:-1]) if m['role'] != 'system']
+        if not droppable:
+            break
+        del trimmed[droppable[0]]
+    return trimmed
+
+
+def tail_lines_within(lines, budget, model=None):
+    """The most recent `lines` whose combined estimate fits `budget`."""
+    kept = []
+    used = 0
+    for line in reversed(lines):
+        cost = estimate_tokens(line, model) + 1
+        if used + cost > budget:
+            break
+        kept.append(line)
+        used += cost
+    return list(reversed(kept))
+
+
+# --- OpenAI Client ---
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "5"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+LLM_BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", "0.5"))  # seconds, doubled on each retry
+LLM_BACKOFF_MAX = float(os.getenv("LLM_BACKOFF_MAX", "8"))
+LLM_POOL_SIZE = int(os.getenv("LLM_POOL_SIZE", "20"))
+
+# Read timeouts (seconds) per route; override one with e.g. LLM_READ_TIMEOUT_FEEDBACK=120
+LLM_READ_TIMEOUTS = {
+    "start_simulation": 30,
+    "summarise": 30,
+    "get_reply": 30,
+    "chat_turn": 30,
+    "hint": 30,
+    "feedback": 90,
+    "feedback_followup": 60,
+    "generate_exam": 30,
+}
+LLM_DEFAULT_READ_TIMEOUT = float(os.getenv("LLM_READ_TIMEOUT", "60"))
+
+# Estimated prompt tokens allowed per route; override one with e.g. LLM_PROMPT_BUDGET_HINT=6000.
+# Oversized prompts are trimmed (oldest dialogue first) or, if that is not enough, refused.
+LLM_PROMPT_BUDGETS = {
+    "start_simulation": 2000,
+    "summarise": 4000,
+    "get_reply": 3500,
+    "chat_turn": 3500,
+    "hint": 4000,
+    "feedback": 12000,
+    "feedback_followup": 12000,
+    "generate_exam": 1500,
+}
+# Default max_tokens per route when the call site does not set one
+LLM_MAX_COMPLETION_TOKENS = {
+    "start_simulation": 150,
+    "summarise": 300,
+    "get_reply": 300,
+    "chat_turn": 300,
+    "hint": 200,
+    "feedback": 500,
+    "feedback_followup": 300,
+    "generate_exam": 250,
+}
+
+# Circuit breaker: after this many consecutive failed (or slow) calls, stop calling OpenAI for the
+# cooldown period, then let a single probe request through to test recovery
+LLM_BREAKER_FAILURE_THRESHOLD = int(os.getenv("LLM_BREAKER_FAILURE_THRESHOLD", "5"))
+LLM_BREAKER_SLOW_CALL_SECONDS = float(os.getenv("LLM_BREAKER_SLOW_CALL_SECONDS", "20"))
+LLM_BREAKER_COOLDOWN_SECONDS = float(os.getenv("LLM_BREAKER_COOLDOWN_SECONDS", "30"))
+
+
+# Completed calls are buffered in memory and bulk-inserted into usage_event by a scheduler job.
+# A flush is started early once the buffer is half full; past USAGE_EVENT_BUFFER_SIZE (the
+# database is down or far behind) new events are counted as dropped instead of being buffered.
+USAGE_EVENT_FLUSH_SECONDS = int(os.getenv("USAGE_EVENT_FLUSH_SECONDS", "15"))
+USAGE_EVENT_BUFFER_SIZE = int(os.getenv("USAGE_EVENT_BUFFER_SIZE", "10000"))
+
+
+class CircuitOpenError(openai.error.OpenAIError):
+    """Raised instead of calling OpenAI while the circuit breaker is open."""
+
+
+class PromptTooLargeError(openai.error.OpenAIError):
+    """Raised before calling OpenAI when a prompt cannot be trimmed to its route's token budget."""
+
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold, cooldown_seconds, slow_call_seconds):
+        self.failure_threshold = failure_threshold
+        self.cooldown_seconds = cooldown_seconds
+        self.slow_call_seconds = slow_call_seconds
+        self._lock = threading.Lock()
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        self.trips = 0
+        self.rejected = 0
+
+    def before_call(self):
+        with self._lock:
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.cooldown_seconds:
+                self.state = self.HALF_OPEN
+                self.probe_in_flight = False
+            if self.state == self.OPEN or (self.state == self.HALF_OPEN and self.probe_in_flight):
+                self.rejected += 1
+                raise CircuitOpenError("OpenAI is unavailable (circuit breaker open)")
+            if self.state == self.HALF_OPEN:
+                self.probe_in_flight = True
+
+    def record_success(self, elapsed):
+        if elapsed > self.slow_call_seconds:
+            logging.warning(f"LLM call took {elapsed:.1f}s, counting it as a circuit breaker failure")
+            self.record_failure()
+            return
+        with self._lock:
+            if self.state != self.CLOSED:
+                logging.info("LLM circuit breaker closed")
+            self.state = self.CLOSED
+            self.consecutive_failures = 0
+            self.probe_in_flight = False
+
+    def release_probe(self):
+        """End a call that says nothing about OpenAI's health (a rejected request, an abandoned stream)."""
+        with self._lock:
+            self.probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+            self.probe_in_flight = False
+            if self.state == self.HALF_OPEN or (
+                    self.state == self.CLOSED and self.consecutive_failures >= self.failure_threshold):
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+                self.trips += 1
+                logging.error(f"LLM circuit breaker opened after {self.consecutive_failures} failures")
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "state": self.state,
+                "consecutive_failures": self.consecutive_failures,
+                "trips": self.trips,
+                "rejected": self.rejected,
+            }
+
+
+class LLMClient:
+    """
+    Wrapper around openai.ChatCompletion shared by every route. It reuses pooled
+    keep-alive HTTP connections, applies per-route timeouts and retries transient
+    failures (429s, 5xxs, timeouts, dropped connections) with jittered backoff.
+    """
+
+    def __init__(self):
+        self.http = requests.Session()
+        adapter = HTTPAdapter(pool_connections=LLM_POOL_SIZE, pool_maxsize=LLM_POOL_SIZE)
+        self.http.mount("https://", adapter)
+        self.http.mount("http://", adapter)
+        openai.requestssession = self.http
+        self._lock = threading.Lock()
+        self.counters = {"calls": 0, "retries": 0, "timeouts": 0, "failures": 0,
+                         "trimmed_prompts": 0, "rejected_prompts": 0, "dropped_usage_events": 0}
+        self.breaker = CircuitBreaker(LLM_BREAKER_FAILURE_THRESHOLD, LLM_BREAKER_COOLDOWN_SECONDS,
+                                      LLM_BREAKER_SLOW_CALL_SECONDS)
+        # Completed calls waiting to be written to the usage_event ledger (see flush_usage_events)
+        self.usage_events = collections.deque()
+
+    def _incr(self, name, amount=1):
+        with self._lock:
+            self.counters[name] += amount
+
+    def snapshot(self):
+        with self._lock:
+            counters = dict(self.counters)
+        counters["breaker"] = self.breaker.snapshot()
+        counters["pending_usage_events"] = len(self.usage_events)
+        return counters
+
+    def record_usage_event(self, route, model, user_id, simulation_id, prompt_tokens, completion_tokens, started):
+        if len(self.usage_events) >= USAGE_EVENT_BUFFER_SIZE:
+            with self._lock:
+                self.counters["dropped_usage_events"] += 1
+                dropped = self.counters["dropped_usage_events"]
+            if dropped == 1 or dropped % 1000 == 0:
+                logging.error(f"Usage event buffer is full ({USAGE_EVENT_BUFFER_SIZE}); "
+                              f"{dropped} usage events dropped so far")
+            return
+        self.usage_events.append({
+            "user_id": user_id,
+            "simulation_id": simulation_id,
+            "route": route,
+            "model": model,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "latency_ms": int((time.monotonic() - started) * 1000),
+            "created_at": datetime.utcnow(),
+        })
+        if len(self.usage_events) >= USAGE_EVENT_BUFFER_SIZE // 2:
+            kick_usage_event_flush()
+
+    def drain_usage_events(self):
+        events = []
+        while True:
+            try:
+                events.append(self.usage_events.popleft())
+            except IndexError:
+                return events
+
+    def requeue_usage_events(self, events):
+        # Back at the front, in order; the buffer is not capped here, so nothing queued is evicted
+        self.usage_events.extendleft(reversed(events))
+
+    def _track_stream(self, response, route, model, messages, user_id, simulation_id, started, opened_in):
+        # Streamed responses carry no usage block, so the ledger gets local estimates once the
+        # stream is finished (or abandoned by the client). The breaker hears about the call only
+        # once the stream has been read to the end, judged on how long the stream took to open.
+        parts = []
+        outcome = None
+        try:
+            for chunk in response:
+                delta = chunk.choices[0].delta.get("content")
+                if delta:
+                    parts.append(delta)
+                yield chunk
+            outcome = "success"
+        except Exception:
+            outcome = "failure"
+            raise
+        finally:
+            if outcome == "success":
+                self.breaker.record_success(opened_in)
+            elif outcome == "failure":
+                self.breaker.record_failure()
+                self._incr("failures")
+            else:
+                self.breaker.release_probe()
+            self.record_usage_event(route, model, user_id, simulation_id,
+                                    estimate_message_tokens(messages, model),
+                                    estimate_tokens("".join(parts), model), started)
+
+    @staticmethod
+    def timeout_for(route):
+        read_timeout = os.getenv(f"LLM_READ_TIMEOUT_{route.upper()}")
+        if read_timeout is None:
+            read_timeout = LLM_READ_TIMEOUTS.get(route, LLM_DEFAULT_READ_TIMEOUT)
+        return LLM_CONNECT_TIMEOUT, float(read_timeout)
+
+    @staticmethod
+    def prompt_budget_for(route):
+        budget = os.getenv(f"LLM_PROMPT_BUDGET_{route.upper()}")
+        return int(budget) if budget is not None else LLM_PROMPT_BUDGETS.get(route)
+
+    @staticmethod
+    def max_tokens_for(route):
+        max_tokens = os.getenv(f"LLM_MAX_TOKENS_{route.upper()}")
+        return int(max_tokens) if max_tokens is not None else LLM_MAX_COMPLETION_TOKENS.get(route)
+
+    def _fit_to_budget(self, route, model, messages):
+        budget = self.prompt_budget_for(route)
+        if not budget:
+            return messages
+        prompt_tokens = estimate_message_tokens(messages, model)
+        if prompt_tokens <= budget:
+            return messages
+        trimmed = trim_messages(messages, budget, model)
+        trimmed_tokens = estimate_message_tokens(trimmed, model)
+        if trimmed_tokens > budget:
+            self._incr("rejected_prompts")
+            raise PromptTooLargeError(
+                f"Prompt for {route} is ~{prompt_tokens} tokens, over its budget of {budget}"
+            )
+        self._incr("trimmed_prompts")
+        logging.warning(f"Trimmed prompt for {route} from ~{prompt_tokens} to ~{trimmed_tokens} tokens")
+        return trimmed
+
+    @staticmethod
+    def _is_retryable(error):
+        if isinstance(error, (openai.error.RateLimitError, openai.error.ServiceUnavailableError,
+                              openai.error.Timeout, openai.error.APIConnectionError)):
+            return True
+        if isinstance(error, openai.error.APIError):
+            return error.http_status is None or error.http_status >= 500
+        return False
+
+    @staticmethod
+    def _is_caller_error(error):
+        # A 4xx for the request itself (e.g. invalid parameters). Authentication and permission
+        # errors are not: every call fails the same way until the key or account is fixed.
+        if isinstance(error, (openai.error.AuthenticationError, openai.error.PermissionError)):
+            return False
+        if isinstance(error, openai.error.InvalidRequestError):
+            return True
+        return error.http_status is not None and 400 <= error.http_status < 500
+
+    @staticmethod
+    def _backoff_delay(attempt, error):
+        delay = random.uniform(0, min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * 2 ** attempt))
+        retry_after = (getattr(error, "headers", None) or {}).get("retry-after")
+        try:
+            delay = max(delay, min(float(retry_after), LLM_BACKOFF_MAX))
+        except (TypeError, ValueError):
+            pass
+        return delay
+
+    def chat(self, route, model, messages, user_id=None, simulation_id=None, **kwargs):
+        """
+        Create a chat completion for `route`. Raises the last OpenAIError once retries are
+        exhausted, CircuitOpenError straight away while OpenAI is known to be failing, or
+        PromptTooLargeError if the prompt cannot be trimmed to the route's budget.
+        Successful calls are queued for the usage ledger against `user_id`/`simulation_id`.
+        """
+        self._incr("calls")
+        messages = self._fit_to_budget(route, model, messages)
+        max_tokens = self.max_tokens_for(route)
+        if max_tokens and "max_tokens" not in kwargs:
+            kwargs["max_tokens"] = max_tokens
+        attempt = 0
+        started = time.monotonic()
+        while True:
+            self.breaker.before_call()
+            try:
+                response = openai.ChatCompletion.create(
+                    model=model,
+                    messages=messages,
+                    request_timeout=self.timeout_for(route),
+                    **kwargs
+                )
+                if kwargs.get("stream"):
+                    return self._track_stream(response, route, model, messages, user_id, simulation_id, started,
+                                              time.monotonic() - started)
+                self.breaker.record_success(time.monotonic() - started)
+                usage = response.get("usage") or {}
+                self.record_usage_event(route, model, user_id, simulation_id,
+                                        usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0), started)
+                return response
+            except openai.error.OpenAIError as e:
+                if isinstance(e, openai.error.Timeout):
+                    self._incr("timeouts")
+                if not self._is_retryable(e):
+                    if self._is_caller_error(e):
+                        # The request itself was bad; OpenAI may or may not be healthy
+                        self.breaker.release_probe()
+                    else:
+                        self.breaker.record_failure()
+                    self._incr("failures")
+                    raise
+                if attempt >= LLM_MAX_RETRIES or self.breaker.state == CircuitBreaker.HALF_OPEN:
+                    # A failed recovery probe re-opens the breaker straight away rather than retrying
+                    self.breaker.record_failure()
+                    self._incr("failures")
+                    raise
+                delay = self._backoff_delay(attempt, e)
+                attempt += 1
+                self._incr("retries")
+                logging.warning(f"LLM call for {route} failed ({e}); retry {attempt} in {delay:.2f}s")
+                time.sleep(delay)
+
+
+llm_client = LLMClient()
 
 # Initialise Flask app and SQLAlchemy
 app = Flask(__name__)
@@ -114,13 +550,13 @@ s = URLSafeTimedSerializer(app.config['SECRET_KEY'])
 
 
 # --- SMTP Email Helper using Brevo ---
-def send_email_via_brevo(subject, body, to_address, html=False):
-    from_address = os.getenv("FROM_EMAIL", "no-reply@email.simul-ai-tor.com")
-    smtp_server = "smtp-relay.brevo.com"  # Brevo SMTP host
-    smtp_port = 587  # Typical port for TLS
-    smtp_login = os.getenv("BREVO_SMTP_LOGIN")
-    smtp_password = os.getenv("BREVO_SMTP_PASSWORD")
+SMTP_HOST = os.getenv("SMTP_HOST", "smtp-relay.brevo.com")  # Brevo SMTP host
+SMTP_PORT = int(os.getenv("SMTP_PORT", "587"))  # Typical port for TLS
+SMTP_STARTTLS = os.getenv("SMTP_STARTTLS", "true").lower() == "true"
+SMTP_TIMEOUT = float(os.getenv("SMTP_TIMEOUT", "30"))
+
 
+def build_email_message(subject, body, to_address, html=False):
     # Choose MIME type based on whether HTML is desired
     if html:
         msg = MIMEText(body, 'html')
@@ -128,20 +564,63 @@ def send_email_via_brevo(subject, body, to_address, html=False):
         msg = MIMEText(body)  # defaults to plain text
 
     msg["Subject"] = subject
-    msg["From"] = from_address
+    msg["From"] = os.getenv("FROM_EMAIL", "no-reply@email.simul-ai-tor.com")
     msg["To"] = to_address
 
     # Set the Date header using the Europe/London timezone
     uk_time = datetime.now(pytz.timezone('Europe/London'))
     msg["Date"] = format_datetime(uk_time)
+    return msg
+
+
+class SMTPSender:
+    """
+    One authenticated SMTP connection reused for every message sent inside the `with` block.
+    A connection the server has dropped is reopened once before the send is retried.
+    """
+
+    def __init__(self):
+        self.server = None
+
+    def connect(self):
+        self.server = smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=SMTP_TIMEOUT)
+        if SMTP_STARTTLS:
+            self.server.starttls()  # Enable TLS
+        smtp_login = os.getenv("BREVO_SMTP_LOGIN")
+        if smtp_login:
+            self.server.login(smtp_login, os.getenv("BREVO_SMTP_PASSWORD"))
 
+    def send(self, msg):
+        if self.server is None:
+            self.connect()
+        try:
+            self.server.send_message(msg)
+        except smtplib.SMTPServerDisconnected:
+            self.connect()
+            self.server.send_message(msg)
+
+    def close(self):
+        if self.server is not None:
+            try:
+                self.server.quit()
+            except Exception:
+                pass
+            self.server = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def send_email_via_brevo(subject, body, to_address, html=False):
+    """Send one email straight away on its own connection. Routes should use queue_email instead."""
+    msg = build_email_message(subject, body, to_address, html)
     try:
-        email_string = msg.as_string()
-        logging.debug("DEBUG: Email message to be sent:\n%s", email_string)
-        with smtplib.SMTP(smtp_server, smtp_port) as server:
-            server.starttls()  # Enable TLS
-            server.login(smtp_login, smtp_password)
-            server.send_message(msg)
+        logging.debug("DEBUG: Email message to be sent:\n%s", msg.as_string())
+        with SMTPSender() as sender:
+            sender.send(msg)
             logging.debug(f"Email sent to {to_address} via Brevo SMTP.")
     except Exception as e:
         logging.debug(f"Error sending email to {to_address}: {e}")
@@ -157,7 +636,7 @@ class User(UserMixin, db.Model):
     discipline = db.Column(db.String(100))
     stripe_customer_id = db.Column(db.String(100))
     subscription_id = db.Column(db.String(100))
-    subscription_status = db.Column(db.String(50))
+    subscription_status = db.Column(db.String(50), index=True)
     token_prompt_usage_gpt35 = db.Column(db.Integer, default=0)
     token_completion_usage_gpt35 = db.Column(db.Integer, default=0)
     token_prompt_usage_gpt4 = db.Column(db.Integer, default=0)
@@ -193,6 +672,21 @@ class Feedback(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     user = db.relationship('User', backref=db.backref('feedbacks', lazy=True))
 
+    __table_args__ = (
+        db.Index('ix_feedback_user_id_created_at', 'user_id', 'created_at'),
+    )
+
+
+class UserScoreStats(db.Model):
+    """Per-user feedback aggregate kept up to date by record_feedback_score, used for the leaderboard."""
+    __tablename__ = 'user_score_stats'
+    user_id = db.Column(db.Integer, db.ForeignKey('subscribers.id'), primary_key=True)
+    feedback_count = db.Column(db.Integer, nullable=False, default=0)
+    score_sum = db.Column(db.Float, nullable=False, default=0.0)
+    avg_score = db.Column(db.Float, nullable=False, default=0.0, index=True)
+    last_three_avg = db.Column(db.Float, nullable=False, default=0.0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
 
 class PendingRegistration(db.Model):
     __tablename__ = 'pending_registration'
@@ -207,6 +701,77 @@ class PendingRegistration(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
 
+class StripeSubscription(db.Model):
+    """Local mirror of Stripe subscriptions, kept current by /stripe/webhook."""
+    __tablename__ = 'stripe_subscription'
+    id = db.Column(db.String(100), primary_key=True)  # Stripe subscription id
+    customer_id = db.Column(db.String(100), index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('subscribers.id'), nullable=True, index=True)
+    status = db.Column(db.String(50))
+    current_period_end = db.Column(db.DateTime, nullable=True)
+    cancel_at_period_end = db.Column(db.Boolean, nullable=False, default=False)
+    # Stripe `created` timestamp of the last event applied, so late out-of-order events are ignored
+    last_event_at = db.Column(db.Integer, nullable=True)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+class TrialConversion(db.Model):
+    """One row per trial, enqueued when the trial starts and converted to a subscription once due."""
+    __tablename__ = 'trial_conversion'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('subscribers.id'), nullable=False, index=True)
+    due_at = db.Column(db.DateTime, nullable=False)
+    # pending -> processing -> done; failed after TRIAL_CONVERSION_MAX_ATTEMPTS, cancelled with the trial
+    status = db.Column(db.String(20), nullable=False, default='pending')
+    # Sent to Stripe so a retried or duplicated conversion can't create a second subscription
+    idempotency_key = db.Column(db.String(100), unique=True, nullable=False)
+    # Bumped after each definitive Stripe error; see conversion_request_key
+    key_revision = db.Column(db.Integer, nullable=False, default=0)
+    # Discounts resolved for the current key, so every request under one key sends the same parameters
+    discounts = db.Column(db.JSON, nullable=True)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    claimed_at = db.Column(db.DateTime, nullable=True)
+    last_error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_trial_conversion_status_due_at', 'status', 'due_at'),
+    )
+
+
+class SchedulerLease(db.Model):
+    """Lock row naming the one process that runs the cluster-wide scheduled jobs."""
+    __tablename__ = 'scheduler_lease'
+    name = db.Column(db.String(50), primary_key=True)
+    holder = db.Column(db.String(150), nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+
+class EmailOutbox(db.Model):
+    """Outgoing email queued by queue_email and sent in the background by deliver_email_outbox."""
+    __tablename__ = 'email_outbox'
+    id = db.Column(db.Integer, primary_key=True)
+    to_address = db.Column(db.String(150), nullable=False)
+    subject = db.Column(db.String(255), nullable=False)
+    body = db.Column(db.Text, nullable=False)
+    html = db.Column(db.Boolean, nullable=False, default=False)
+    # pending -> sending -> sent; failed after EMAIL_MAX_ATTEMPTS
+    status = db.Column(db.String(20), nullable=False, default='pending')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    claimed_by = db.Column(db.String(36), nullable=True)
+    claimed_at = db.Column(db.DateTime, nullable=True)
+    last_error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (
+        db.Index('ix_email_outbox_status_next_attempt_at', 'status', 'next_attempt_at'),
+        db.Index('ix_email_outbox_claimed_by', 'claimed_by'),
+    )
+
+
 class AlertSignup(db.Model):
     __tablename__ = 'alert_signup'
     id = db.Column(db.Integer, primary_key=True)
@@ -216,7 +781,7 @@ class AlertSignup(db.Model):
 class DeviceUsage(db.Model):
     __tablename__ = 'device_usage'
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('subscribers.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('subscribers.id'), nullable=False, index=True)
     ip_address = db.Column(db.String(100), nullable=False)
     user_agent = db.Column(db.String(256))
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
@@ -225,9 +790,449 @@ class DeviceUsage(db.Model):
     # Relationship back to user if desired
     user = db.relationship('User', backref=db.backref('devices', lazy=True))
 
+class Simulation(db.Model):
+    __tablename__ = 'simulation'
+    id = db.Column(db.String(36), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('subscribers.id'), nullable=False, index=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Rolling summary of every dialogue turn up to and including turn id `summarized_through`
+    summary = db.Column(db.Text, nullable=True)
+    summarized_through = db.Column(db.Integer, nullable=False, default=0)
+
+
+class ConversationTurn(db.Model):
+    __tablename__ = 'conversation_turn'
+    id = db.Column(db.Integer, primary_key=True)
+    simulation_id = db.Column(db.String(36), db.ForeignKey('simulation.id'), nullable=False)
+    role = db.Column(db.String(20), nullable=False)
+    content = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_conversation_turn_simulation_id_id', 'simulation_id', 'id'),
+    )
+
+
+class FeedbackReport(db.Model):
+    """Consultation feedback for one simulation, generated in the background by generate_feedback_report."""
+    __tablename__ = 'feedback_report'
+    simulation_id = db.Column(db.String(36), db.ForeignKey('simulation.id'), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('subscribers.id'), nullable=False, index=True)
+    # pending -> running -> done; failed once FEEDBACK_MAX_ATTEMPTS runs have not finished
+    status = db.Column(db.String(20), nullable=False, default='pending')
+    feedback_json = db.Column(db.JSON, nullable=True)
+    feedback_raw = db.Column(db.Text, nullable=True)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    claimed_at = db.Column(db.DateTime, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    completed_at = db.Column(db.DateTime, nullable=True)
+
+
+class UsageEvent(db.Model):
+    """Append-only ledger with one row per completed OpenAI call."""
+    __tablename__ = 'usage_event'
+    id = db.Column(db.Integer, primary_key=True)
+    # Null for calls made on nobody's behalf yet, e.g. pre-generating the scenario pool
+    user_id = db.Column(db.Integer, db.ForeignKey('subscribers.id'), nullable=True)
+    simulation_id = db.Column(db.String(36), nullable=True)
+    route = db.Column(db.String(50), nullable=False)
+    model = db.Column(db.String(50), nullable=False)
+    prompt_tokens = db.Column(db.Integer, nullable=False, default=0)
+    completion_tokens = db.Column(db.Integer, nullable=False, default=0)
+    latency_ms = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+    __table_args__ = (
+        db.Index('ix_usage_event_user_id_created_at', 'user_id', 'created_at'),
+    )
+
+
+class UsageDaily(db.Model):
+    """UsageEvent rows rolled up per day, route and model by rollup_usage_daily."""
+    __tablename__ = 'usage_daily'
+    id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, nullable=False)
+    route = db.Column(db.String(50), nullable=False)
+    model = db.Column(db.String(50), nullable=False)
+    calls = db.Column(db.Integer, nullable=False, default=0)
+    users = db.Column(db.Integer, nullable=False, default=0)
+    prompt_tokens = db.Column(db.BigInteger, nullable=False, default=0)
+    completion_tokens = db.Column(db.BigInteger, nullable=False, default=0)
+    total_latency_ms = db.Column(db.BigInteger, nullable=False, default=0)
+
+    __table_args__ = (
+        db.UniqueConstraint('day', 'route', 'model', name='uq_usage_daily_day_route_model'),
+    )
+
+    def to_dict(self):
+        return {
+            "day": self.day.isoformat(),
+            "route": self.route,
+            "model": self.model,
+            "calls": self.calls,
+            "users": self.users,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "avg_latency_ms": round(self.total_latency_ms / self.calls) if self.calls else 0,
+            "cost": round(token_cost(self.model, self.prompt_tokens, self.completion_tokens), 4),
+        }
+
 @login_manager.user_loader
 def load_user(user_id):
-    return db.session.get(User, int(user_id))
+    # Serve the identity from the snapshot cached for this session token when there is one
+    token = session.get('session_token')
+    snapshot = identity_cache.get(f"user:{user_id}") if token else None
+    if snapshot and snapshot["current_session"] == token:
+        return CachedUser(snapshot)
+    user = db.session.get(User, int(user_id))
+    if user and token and user.current_session == token:
+        identity_cache.set(f"user:{user.id}", {column: getattr(user, column) for column in IDENTITY_SNAPSHOT_COLUMNS})
+    return user
+
+
+# --- Token Usage Accounting ---
+USAGE_COLUMNS = {
+    "gpt-3.5-turbo": ("token_prompt_usage_gpt35", "token_completion_usage_gpt35"),
+    "gpt-4-turbo": ("token_prompt_usage_gpt4", "token_completion_usage_gpt4"),
+}
+# "inline" applies each call's usage with one atomic UPDATE straight away. "deferred" buffers it in
+# memory and a scheduler job applies per-user totals every USAGE_FLUSH_SECONDS, off the response path.
+USAGE_FLUSH_MODE = os.getenv("USAGE_FLUSH_MODE", "inline")
+USAGE_FLUSH_SECONDS = int(os.getenv("USAGE_FLUSH_SECONDS", "10"))
+
+_usage_lock = threading.Lock()
+_pending_usage = collections.defaultdict(int)  # (user_id, column) -> tokens not yet written
+
+
+def apply_token_usage(user_id, increments):
+    """
+    Add {column: tokens} to a user's counters with a single UPDATE ... SET col = col + :n, so
+    concurrent requests for the same user can't overwrite each other's totals.
+    """
+    values = {col: db.func.coalesce(getattr(User, col), 0) + tokens for col, tokens in increments.items() if tokens}
+    if not values:
+        return
+    db.session.execute(
+        db.update(User).where(User.id == user_id).values(**values).execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+
+
+def record_token_usage(user_id, model, prompt_tokens, completion_tokens):
+    prompt_col, completion_col = USAGE_COLUMNS[model]
+    if USAGE_FLUSH_MODE == "deferred":
+        with _usage_lock:
+            _pending_usage[(user_id, prompt_col)] += prompt_tokens
+            _pending_usage[(user_id, completion_col)] += completion_tokens
+        return
+    apply_token_usage(user_id, {prompt_col: prompt_tokens, completion_col: completion_tokens})
+
+
+def record_response_usage(user_id, model, response):
+    if response.usage and 'prompt_tokens' in response.usage and 'completion_tokens' in response.usage:
+        record_token_usage(user_id, model, response.usage['prompt_tokens'], response.usage['completion_tokens'])
+
+
+def flush_token_usage():
+    with _usage_lock:
+        pending = dict(_pending_usage)
+        _pending_usage.clear()
+    by_user = collections.defaultdict(dict)
+    for (user_id, col), tokens in pending.items():
+        by_user[user_id][col] = tokens
+    with app.app_context():
+        for user_id, increments in by_user.items():
+            try:
+                apply_token_usage(user_id, increments)
+            except Exception as e:
+                db.session.rollback()
+                logging.error(f"Error flushing token usage for user {user_id}: {e}")
+                with _usage_lock:
+                    for col, tokens in increments.items():
+                        _pending_usage[(user_id, col)] += tokens
+
+
+def flush_usage_events():
+    """Bulk-insert the LLM client's buffered calls into the usage_event ledger."""
+    events = llm_client.drain_usage_events()
+    if not events:
+        return
+    with app.app_context():
+        try:
+            db.session.execute(db.insert(UsageEvent), events)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logging.error(f"Error writing {len(events)} usage events: {e}")
+            llm_client.requeue_usage_events(events)
+
+
+def kick_usage_event_flush():
+    # Write the ledger now rather than at the next interval
+    if scheduler.running:
+        run_soon(flush_usage_events, 'usage_event_flush_kick')
+
+
+def rollup_usage_daily(day=None):
+    """
+    Recompute usage_daily for `day` (default: yesterday, UTC) from the ledger. Safe to re-run;
+    the day's existing rows are replaced.
+    """
+    day = day or (datetime.utcnow() - timedelta(days=1)).date()
+    start = datetime.combine(day, datetime.min.time())
+    with app.app_context():
+        try:
+            rows = db.session.query(
+                UsageEvent.route,
+                UsageEvent.model,
+                db.func.count(UsageEvent.id),
+                db.func.count(db.distinct(UsageEvent.user_id)),
+                db.func.coalesce(db.func.sum(UsageEvent.prompt_tokens), 0),
+                db.func.coalesce(db.func.sum(UsageEvent.completion_tokens), 0),
+                db.func.coalesce(db.func.sum(UsageEvent.latency_ms), 0),
+            ).filter(
+                UsageEvent.created_at >= start,
+                UsageEvent.created_at < start + timedelta(days=1)
+            ).group_by(UsageEvent.route, UsageEvent.model).all()
+            UsageDaily.query.filter_by(day=day).delete()
+            for route, model, calls, users, prompt_tokens, completion_tokens, latency_ms in rows:
+                db.session.add(UsageDaily(day=day, route=route, model=model, calls=calls, users=users,
+                                          prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                                          total_latency_ms=latency_ms))
+            db.session.commit()
+            logging.debug(f"Rolled up usage for {day}: {len(rows)} route/model rows")
+        except Exception as e:
+            db.session.rollback()
+            logging.error(f"Error rolling up usage for {day}: {e}")
+
+
+# --- Email Outbox ---
+EMAIL_OUTBOX_POLL_SECONDS = int(os.getenv("EMAIL_OUTBOX_POLL_SECONDS", "30"))
+EMAIL_OUTBOX_BATCH = int(os.getenv("EMAIL_OUTBOX_BATCH", "100"))
+EMAIL_MAX_ATTEMPTS = int(os.getenv("EMAIL_MAX_ATTEMPTS", "5"))
+EMAIL_RETRY_BASE_SECONDS = int(os.getenv("EMAIL_RETRY_BASE_SECONDS", "60"))
+# Parallel SMTP connections used by one delivery run (each sends whole batches)
+EMAIL_SENDER_CONNECTIONS = int(os.getenv("EMAIL_SENDER_CONNECTIONS", "4"))
+# A claim older than this is assumed to belong to a process that died mid-send
+EMAIL_CLAIM_TIMEOUT = timedelta(minutes=10)
+
+
+def queue_email(subject, body, to_address, html=False):
+    """
+    Add an email to the outbox in the current session; the caller commits. It is sent in the
+    background within a moment of the commit, and not at all if the transaction is rolled back.
+    """
+    db.session.add(EmailOutbox(to_address=to_address, subject=subject, body=body, html=html,
+                               status='pending', attempts=0, next_attempt_at=datetime.utcnow()))
+    db.session.info["email_queued"] = True
+
+
+@event.listens_for(db.session, "after_commit")
+def kick_email_delivery_after_commit(session):
+    if session.info.pop("email_queued", False):
+        kick_email_delivery()
+
+
+@event.listens_for(db.session, "after_rollback")
+def discard_email_kick(session):
+    session.info.pop("email_queued", None)
+
+
+def kick_email_delivery():
+    # Deliver now from this process's scheduler rather than waiting for the next sweep
+    if scheduler.running:
+        run_soon(deliver_email_outbox, 'email_outbox_kick')
+
+
+def email_due_filter(now):
+    return db.or_(
+        db.and_(EmailOutbox.status == 'pending', EmailOutbox.next_attempt_at <= now),
+        db.and_(EmailOutbox.status == 'sending', EmailOutbox.claimed_at < now - EMAIL_CLAIM_TIMEOUT)
+    )
+
+
+def claim_outbox_batch(limit):
+    """Mark up to `limit` due emails as `sending` under a fresh claim token and return them."""
+    while True:
+        now = datetime.utcnow()
+        # SKIP LOCKED (Postgres) lets concurrent senders take disjoint batches instead of queueing
+        ids = [row.id for row in db.session.query(EmailOutbox.id).filter(email_due_filter(now))
+               .order_by(EmailOutbox.id).limit(limit).with_for_update(skip_locked=True)]
+        if not ids:
+            db.session.commit()
+            return []
+        token = str(uuid.uuid4())
+        db.session.execute(
+            db.update(EmailOutbox).where(EmailOutbox.id.in_(ids), email_due_filter(now)).values(
+                status='sending', claimed_by=token, claimed_at=now, attempts=EmailOutbox.attempts + 1
+            ).execution_options(synchronize_session=False)
+        )
+        db.session.commit()
+        batch = EmailOutbox.query.filter_by(claimed_by=token).order_by(EmailOutbox.id).all()
+        if batch:
+            return batch
+        # Another sender claimed every row we selected; look again
+
+
+def record_email_failure(email, error):
+    email.last_error = str(error)
+    if email.attempts >= EMAIL_MAX_ATTEMPTS:
+        email.status = 'failed'
+        email.body = ''
+        logging.error(f"Giving up on email {email.id} to {email.to_address}: {error}")
+    else:
+        email.status = 'pending'
+        email.next_attempt_at = datetime.utcnow() + timedelta(
+            seconds=EMAIL_RETRY_BASE_SECONDS * 2 ** (email.attempts - 1))
+
+
+def send_outbox_batch(sender, batch):
+    """
+    Send `batch` over `sender`'s connection, recording each message's outcome on its row.
+    A message the server rejects is retried later on its own; a lost connection aborts the batch.
+    """
+    for email in batch:
+        try:
+            sender.send(build_email_message(email.subject, email.body, email.to_address, email.html))
+        except smtplib.SMTPServerDisconnected:
+            raise
+        except smtplib.SMTPException as e:
+            logging.warning(f"Error sending email {email.id} to {email.to_address}: {e}")
+            record_email_failure(email, e)
+            continue
+        email.status = 'sent'
+        email.sent_at = datetime.utcnow()
+        email.last_error = None
+        # Bodies carry sign-in, confirmation and reset links; keep only the envelope once it's gone
+        email.body = ''
+
+
+def deliver_email_outbox():
+    """
+    Send due outbox emails until none are left, over up to EMAIL_SENDER_CONNECTIONS connections in
+    parallel. Safe to run in several processes at once.
+    """
+    if EMAIL_SENDER_CONNECTIONS <= 1:
+        deliver_over_one_connection()
+        return
+    with ThreadPoolExecutor(max_workers=EMAIL_SENDER_CONNECTIONS, thread_name_prefix="email") as pool:
+        for future in [pool.submit(deliver_over_one_connection) for _ in range(EMAIL_SENDER_CONNECTIONS)]:
+            future.result()
+
+
+def deliver_over_one_connection():
+    with app.app_context(), SMTPSender() as sender:
+        while True:
+            batch = claim_outbox_batch(EMAIL_OUTBOX_BATCH)
+            if not batch:
+                return
+            try:
+                send_outbox_batch(sender, batch)
+            except Exception as e:
+                logging.error(f"Error delivering email batch: {e}")
+                sender.close()
+                for email in batch:
+                    if email.status == 'sending':
+                        record_email_failure(email, e)
+                db.session.commit()
+                return
+            db.session.commit()
+
+
+# --- Caching ---
+# "simple" keeps entries in each worker process; "filesystem" shares them between the workers on a
+# host (under CACHE_DIR), so an invalidation in one worker is seen by all of them. gunicorn.conf.py
+# switches to "filesystem" (or refuses to start) when more than one worker is configured.
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "simple")
+CACHE_DIR = os.getenv("CACHE_DIR", os.path.join(os.getcwd(), "flask_cache"))
+ACTIVE_COUNT_CACHE_SECONDS = int(os.getenv("ACTIVE_COUNT_CACHE_SECONDS", "30"))
+# With the per-process backend, a login from another device is noticed by the other workers within this
+IDENTITY_CACHE_SECONDS = int(os.getenv("IDENTITY_CACHE_SECONDS", "60"))
+MAX_ACTIVE_SUBSCRIPTIONS = 100
+
+
+def make_cache(namespace, default_timeout, threshold=500):
+    # Past `threshold` entries the cache evicts expired entries, then the oldest ones
+    if CACHE_BACKEND == "filesystem":
+        return FileSystemCache(os.path.join(CACHE_DIR, namespace), threshold=threshold,
+                               default_timeout=default_timeout)
+    return SimpleCache(threshold=threshold, default_timeout=default_timeout)
+
+
+subscriber_cache = make_cache("subscribers", ACTIVE_COUNT_CACHE_SECONDS)
+identity_cache = make_cache("identity", IDENTITY_CACHE_SECONDS)
+
+# User columns held in the identity snapshot (token counters are updated in bulk SQL, so are left out)
+IDENTITY_SNAPSHOT_COLUMNS = (
+    "id", "email", "category", "discipline", "stripe_customer_id", "subscription_id", "subscription_status",
+    "is_admin", "current_session", "last_device_change", "trial_start", "stored_payment_method_id", "promo_code",
+)
+
+
+class CachedUser(UserMixin):
+    """
+    Stand-in for current_user built from an identity_cache snapshot, so requests that only read
+    identity fields don't query the database. Any other attribute, and every assignment, goes to
+    the real User row, which is loaded on first use and then used for all further access.
+    """
+
+    def __init__(self, snapshot):
+        object.__setattr__(self, "_snapshot", snapshot)
+        object.__setattr__(self, "_row", None)
+
+    @property
+    def row(self):
+        if self._row is None:
+            object.__setattr__(self, "_row", db.session.get(User, self._snapshot["id"]))
+        return self._row
+
+    def __getattr__(self, name):
+        if self._row is None and name in self._snapshot:
+            return self._snapshot[name]
+        return getattr(self.row, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.row, name, value)
+
+
+def current_user_row():
+    """The User row behind current_user, for views that modify the account."""
+    user = current_user._get_current_object()
+    return user.row if isinstance(user, CachedUser) else user
+
+
+def get_active_subscriber_count():
+    """Active subscription count for the seat cap, cached for ACTIVE_COUNT_CACHE_SECONDS."""
+    count = subscriber_cache.get("active_count")
+    if count is None:
+        count = User.query.filter(User.subscription_status == 'active').count()
+        subscriber_cache.set("active_count", count)
+    return count
+
+
+@event.listens_for(db.session, "before_flush")
+def note_user_changes(session, flush_context, instances):
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if not isinstance(obj, User):
+            continue
+        if obj.id is not None:
+            session.info.setdefault("changed_user_ids", set()).add(obj.id)
+        if db.inspect(obj).attrs.subscription_status.history.has_changes():
+            session.info["subscription_status_changed"] = True
+
+
+@event.listens_for(db.session, "after_commit")
+def invalidate_user_caches(session):
+    if session.info.pop("subscription_status_changed", False):
+        subscriber_cache.delete("active_count")
+    for user_id in session.info.pop("changed_user_ids", ()):
+        identity_cache.delete(f"user:{user_id}")
+
+
+@event.listens_for(db.session, "after_rollback")
+def discard_user_changes(session):
+    session.info.pop("subscription_status_changed", None)
+    session.info.pop("changed_user_ids", None)
 
 
 # --- Before Request: Ensure Single Session per User ---
@@ -600,6 +1605,11 @@ FEEDBACK_INSTRUCTION = (
     "Use British English spellings. End with: \"Thank you for the consultation. Goodbye.\" Here is the consultation transcript to review:"
 )
 
+# The system prompt scripts the patient's first line verbatim, so by default it is seeded locally
+# rather than paying for a gpt-4-turbo round trip. Set FAST_START=false to generate it with the model.
+FAST_START = os.getenv("FAST_START", "true").lower() == "true"
+PATIENT_OPENER = "Can I speak with someone about my symptoms?"
+
 PROMPT_INSTRUCTION = (
     "You are a Calgary Cambridge communication expert. Based on the following consultation transcript, provide one single, concise "
     "suggested next question for the user to ask, ensuring that essential patient details (e.g., demographics, personal history, key "
@@ -616,34 +1626,113 @@ account_bp = Blueprint('account', __name__, url_prefix='/account')
 def account():
     subscription_info = None
     trial_active = False
-    trial_period = timedelta(hours=1)  # Define the trial period
 
     if current_user.subscription_id:
         try:
-            subscription = stripe.Subscription.retrieve(current_user.subscription_id)
-            logging.debug("DEBUG: Stripe subscription retrieved: %s", subscription)
-            current_period_end = datetime.utcfromtimestamp(subscription.current_period_end).strftime(
-                "%Y-%m-%d %H:%M:%S")
+            mirror = db.session.get(StripeSubscription, current_user.subscription_id)
+            if mirror is None:
+                # Not mirrored yet (subscribed before the webhook existed): fetch it once from Stripe
+                mirror = sync_stripe_subscription(stripe.Subscription.retrieve(current_user.subscription_id))
+                db.session.commit()
+            current_period_end = mirror.current_period_end.strftime(
+                "%Y-%m-%d %H:%M:%S") if mirror.current_period_end else None
             subscription_info = {
-                "cancel_at_period_end": subscription.cancel_at_period_end,
+                "cancel_at_period_end": mirror.cancel_at_period_end,
                 "current_period_end": current_period_end,
-                "status": subscription.status
+                "status": mirror.status
             }
             logging.debug("DEBUG: subscription_info: %s", subscription_info)
         except Exception as e:
+            db.session.rollback()
             flash(f"Error retrieving subscription info: {str(e)}", "danger")
     else:
         logging.debug("DEBUG: current_user.subscription_id is not set")
 
     # Determine if trial is active (only check if user hasn't converted to a subscription)
     if current_user.trial_start:
-        if datetime.utcnow() < current_user.trial_start + trial_period:
+        if datetime.utcnow() < current_user.trial_start + TRIAL_PERIOD:
             trial_active = True
 
     return render_template('account.html', subscription_info=subscription_info, trial_active=trial_active)
 
 app.register_blueprint(account_bp)
 
+
+# --- Stripe Webhook and Subscription Mirror ---
+STRIPE_SUBSCRIPTION_EVENTS = (
+    "customer.subscription.created",
+    "customer.subscription.updated",
+    "customer.subscription.deleted",
+)
+
+
+def sync_stripe_subscription(subscription, event_created=None):
+    """
+    Upsert the StripeSubscription mirror row (and the owning user's subscription_status) from a
+    Stripe subscription object. The caller commits. Events older than the last one applied are skipped.
+    """
+    mirror = db.session.get(StripeSubscription, subscription["id"])
+    if mirror is None:
+        mirror = StripeSubscription(id=subscription["id"])
+        db.session.add(mirror)
+    elif event_created and mirror.last_event_at and event_created < mirror.last_event_at:
+        logging.debug(f"Ignoring out-of-order event for subscription {subscription['id']}")
+        return mirror
+
+    period_end = subscription.get("current_period_end")
+    if period_end is None and subscription.get("items") and subscription["items"].get("data"):
+        # Newer API versions report the billing period per subscription item
+        period_end = subscription["items"]["data"][0].get("current_period_end")
+
+    mirror.customer_id = subscription.get("customer")
+    mirror.status = subscription.get("status")
+    mirror.current_period_end = datetime.utcfromtimestamp(period_end) if period_end else None
+    mirror.cancel_at_period_end = bool(subscription.get("cancel_at_period_end"))
+    if event_created:
+        mirror.last_event_at = event_created
+
+    user = User.query.filter_by(subscription_id=mirror.id).first()
+    if user is None and mirror.customer_id:
+        user = User.query.filter_by(stripe_customer_id=mirror.customer_id).first()
+    if user is not None:
+        mirror.user_id = user.id
+        if user.subscription_id == mirror.id and user.subscription_status != mirror.status:
+            user.subscription_status = mirror.status
+    return mirror
+
+
+@app.route('/stripe/webhook', methods=['POST'])
+@csrf.exempt
+def stripe_webhook():
+    if not STRIPE_WEBHOOK_SECRET:
+        # Without the signing secret no event can be verified, so none is accepted; Stripe keeps
+        # retrying the deliveries until the secret is configured
+        logging.error("Rejected Stripe webhook: STRIPE_WEBHOOK_SECRET is not set")
+        return jsonify({"error": "Webhook not configured"}), 503
+    payload = request.get_data()
+    signature = request.headers.get('Stripe-Signature', '')
+    try:
+        stripe_event = stripe.Webhook.construct_event(payload, signature, STRIPE_WEBHOOK_SECRET)
+    except ValueError:
+        logging.warning("Rejected Stripe webhook with an unparseable payload")
+        return jsonify({"error": "Invalid payload"}), 400
+    except stripe.error.SignatureVerificationError:
+        logging.warning("Rejected Stripe webhook with an invalid signature")
+        return jsonify({"error": "Invalid signature"}), 400
+
+    if stripe_event["type"] in STRIPE_SUBSCRIPTION_EVENTS:
+        try:
+            sync_stripe_subscription(stripe_event["data"]["object"], stripe_event.get("created"))
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logging.error(f"Error applying Stripe event {stripe_event.get('id')}: {e}")
+            # A non-2xx response makes Stripe retry the delivery
+            return jsonify({"error": "Could not apply event"}), 500
+    else:
+        logging.debug(f"Ignoring Stripe event type {stripe_event['type']}")
+    return jsonify({"received": True})
+
 @app.route('/terms.html')
 def terms():
     return render_template('terms.html')
@@ -666,13 +1755,15 @@ def cancel_subscription():
     try:
         subscription = stripe.Subscription.modify(user.subscription_id, cancel_at_period_end=True)
         user.subscription_status = subscription.status
+        sync_stripe_subscription(subscription)
         db.session.commit()
         subject = "Subscription Cancellation Confirmation"
         body = (
             "Hello,\n\nYour subscription has been scheduled for cancellation at the end of your current billing period. "
             "You will retain access until that time.\n\nThank you. Please note: This is an automated email and replies to this address are not monitored."
         )
-        send_email_via_brevo(subject, body, user.email)
+        queue_email(subject, body, user.email)
+        db.session.commit()
         flash(
             "Your subscription will be cancelled at the end of the current billing period. "
             "Please note: This is an automated email and replies to this address are not monitored.",
@@ -734,6 +1825,7 @@ def reactivate_payment_success():
         current_user.stripe_customer_id = stripe_customer_id
         current_user.subscription_id = subscription_id
         current_user.subscription_status = subscription.status
+        sync_stripe_subscription(subscription)
         db.session.commit()
 
         subject = "Subscription Reactivation Confirmation"
@@ -741,7 +1833,8 @@ def reactivate_payment_success():
             "Hello,\n\nYour subscription has been reactivated. Enjoy using Simul-AI-tor.\n\n"
             "Best regards,\nThe Support Team. Please note: This is an automated email and replies to this address are not monitored."
         )
-        send_email_via_brevo(subject, body, current_user.email)
+        queue_email(subject, body, current_user.email)
+        db.session.commit()
         flash("Subscription reactivated successfully! A confirmation email has been sent.", "success")
     except Exception as e:
         flash(f"Error processing reactivation: {str(e)}", "danger")
@@ -750,8 +1843,7 @@ def reactivate_payment_success():
 
 @app.route('/')
 def landing():
-    active_count = User.query.filter(User.subscription_status == 'active').count()
-    remaining_places = max(100 - active_count, 0)
+    remaining_places = max(MAX_ACTIVE_SUBSCRIPTIONS - get_active_subscriber_count(), 0)
     return render_template('landing.html', remaining_places=remaining_places)
 
 ADMIN_LOGIN_PASSWORD = os.getenv("ADMIN_LOGIN_PASSWORD")
@@ -797,36 +1889,18 @@ def login():
                     return redirect(url_for('reactivate_subscription'))
 
                 now = datetime.now()  # using local time instead of UTC
-                trial_period = timedelta(hours=1)
 
                 # For non-admin users without an active subscription...
                 if not user.is_admin and (not user.subscription_id or user.subscription_status != "active"):
                     if user.trial_start:
-                        expiry = user.trial_start + trial_period
+                        expiry = user.trial_start + TRIAL_PERIOD
                         logging.debug(f"Trial check: now={now}, trial_start={user.trial_start}, expiry={expiry}")
                         if now >= expiry:
                             logging.debug(f"Trial expired for {user.email}, attempting subscription conversion...")
                             if user.stored_payment_method_id:
-                                discounts = []
-                                if user.promo_code:
-                                    try:
-                                        promo_list = stripe.PromotionCode.list(code=user.promo_code, active=True)
-                                        if promo_list.data:
-                                            promo = promo_list.data[0]
-                                            discounts = [{"promotion_code": promo.id}]
-                                    except Exception as e:
-                                        logging.warning(f"Failed to validate promo code: {e}")
                                 try:
-                                    subscription = stripe.Subscription.create(
-                                        customer=user.stripe_customer_id,
-                                        items=[{"price": STRIPE_PRICE_ID}],
-                                        default_payment_method=user.stored_payment_method_id,
-                                        discounts=discounts
-                                    )
-                                    user.subscription_id = subscription.id
-                                    user.subscription_status = subscription.status
-                                    db.session.commit()
-                                    flash("Your free trial has now converted to an active subscription.", "success")
+                                    if convert_trial_for_user(user):
+                                        flash("Your free trial has now converted to an active subscription.", "success")
                                 except Exception as e:
                                     flash(f"Error converting trial: {str(e)}", "danger")
                                     return redirect(url_for('start_payment'))
@@ -862,7 +1936,7 @@ def login():
                                 token = s.dumps({"user_id": user.id, "ip": user_ip, "ua": user_agent},
                                                 salt='device-confirmation-salt')
                                 confirmation_link = url_for('confirm_device', token=token, _external=True)
-                                send_email_via_brevo("New Device Confirmation",
+                                queue_email("New Device Confirmation",
                                                      f"Click here to confirm your new device: {confirmation_link}",
                                                      user.email, html=False)
                                 user.last_device_change = now
@@ -882,7 +1956,7 @@ def login():
                         db.session.commit()
 
                 # Finalise login process
-                session.pop('conversation', None)
+                session.pop('simulation_id', None)
                 user.current_session = str(uuid.uuid4())
                 db.session.commit()
                 session['session_token'] = user.current_session
@@ -925,8 +1999,7 @@ def confirm_device(token):
 
 @app.route('/register', methods=['GET', 'POST'])
 def register():
-    active_count = User.query.filter(User.subscription_status == 'active').count()
-    if active_count >= 100:
+    if get_active_subscriber_count() >= MAX_ACTIVE_SUBSCRIPTIONS:
         flash("All subscription spaces are currently taken. Please sign up for alerts when a space becomes available.",
               "info")
         return redirect(url_for('alert_signup'))
@@ -994,7 +2067,8 @@ def register():
             # Replace the placeholder with the actual confirmation link
             html_body = html_body.replace("{{ confirmation_link }}", confirmation_link)
             subject = "Please Confirm Your Email Address"
-            send_email_via_brevo(subject, html_body, pending_registration["email"], html=True)
+            queue_email(subject, html_body, pending_registration["email"], html=True)
+            db.session.commit()
             logging.debug(f"DEBUG: Confirmation email sent to: {pending_registration['email']}")
         except Exception as e:
             logging.debug("DEBUG: Error sending confirmation email:", e)
@@ -1045,7 +2119,8 @@ def alert_signup():
                 "Thank you for signing up for alerts! "
                 "We will notify you as soon as a subscription space becomes available."
             )
-            send_email_via_brevo(subject, body, email)
+            queue_email(subject, body, email)
+            db.session.commit()
             logging.debug(f"Alert signup email sent to {email}")
             flash("Thank you! You've been signed up for alerts.", "success")
         except Exception as e:
@@ -1093,7 +2168,8 @@ def resend_confirmation():
               </body>
             </html>
             """
-            send_email_via_brevo(subject, html_body, pending.email, html=True)
+            queue_email(subject, html_body, pending.email, html=True)
+            db.session.commit()
             flash("A new confirmation email has been sent. Please check your inbox.", "info")
         except Exception as e:
             flash(f"Error sending new confirmation email: {str(e)}", "warning")
@@ -1170,7 +2246,7 @@ def cancel_stripe():
     flash("Payment was cancelled. Please log in again to retry.", "warning")
     logout_user()  # Log the user out
     # Optionally, clear any session variables related to payment or registration.
-    session.pop('conversation', None)
+    session.pop('simulation_id', None)
     session.pop('pending_registration', None)
     return redirect(url_for('login'))
 
@@ -1191,8 +2267,8 @@ def after_setup():
         payment_method_id = setup_intent.payment_method
         logging.debug("DEBUG: Retrieved payment_method_id from setup_intent: %s", payment_method_id)
 
-        # Reload the user from the database and update the payment method
-        user = User.query.get(current_user.id)
+        # Load the user row and update the payment method
+        user = current_user_row()
         user.stored_payment_method_id = payment_method_id
 
         # Stamp the trial start time if it hasn't been set yet
@@ -1201,6 +2277,7 @@ def after_setup():
             logging.debug("DEBUG: trial_start set to %s", user.trial_start)
         else:
             logging.debug("DEBUG: trial_start already exists: %s", user.trial_start)
+        schedule_trial_conversion(user)
 
         # Commit the changes to the database
         db.session.commit()
@@ -1218,50 +2295,172 @@ def after_setup():
 @app.route('/convert_trial')
 @login_required
 def convert_trial():
-    # Assuming you've stored the trial start time on the user model
-    # and that stored_payment_method_id is saved for the user.
-    trial_period = timedelta(hours=1)
-    if current_user.trial_start and datetime.utcnow() >= current_user.trial_start + trial_period:
-        # Create the subscription without a trial period
+    user = current_user_row()
+    if user.trial_start and datetime.utcnow() >= user.trial_start + TRIAL_PERIOD:
+        try:
+            if convert_trial_for_user(user):
+                flash("Your subscription is now active!", "success")
+            else:
+                flash("Your subscription is being set up. Please check back in a moment.", "info")
+        except Exception as e:
+            flash(f"Error converting trial: {str(e)}", "danger")
+    else:
+        flash("Your trial period is still active.", "info")
+    return redirect(url_for('account'))
+
+
+# --- Trial Conversion Jobs ---
+TRIAL_CONVERSION_POLL_SECONDS = int(os.getenv("TRIAL_CONVERSION_POLL_SECONDS", "60"))
+TRIAL_CONVERSION_BATCH = int(os.getenv("TRIAL_CONVERSION_BATCH", "50"))
+TRIAL_CONVERSION_MAX_ATTEMPTS = int(os.getenv("TRIAL_CONVERSION_MAX_ATTEMPTS", "5"))
+# A claim older than this is assumed to belong to a worker that died mid-conversion
+TRIAL_CONVERSION_CLAIM_TIMEOUT = timedelta(minutes=10)
+
+
+def schedule_trial_conversion(user):
+    """Enqueue (once per trial) the conversion of `user`'s trial, due when the trial ends. The caller commits."""
+    key = f"trial-{user.id}-{int(user.trial_start.timestamp())}"
+    conversion = TrialConversion.query.filter_by(idempotency_key=key).first()
+    if conversion is None:
+        conversion = TrialConversion(user_id=user.id, due_at=user.trial_start + TRIAL_PERIOD,
+                                     status='pending', attempts=0, idempotency_key=key)
+        db.session.add(conversion)
+        db.session.flush()
+    return conversion
+
+
+def claim_trial_conversion(conversion_id):
+    """Atomically move a due conversion to `processing`; only one worker or request can win."""
+    now = datetime.utcnow()
+    claimed = db.session.execute(
+        db.update(TrialConversion).where(
+            TrialConversion.id == conversion_id,
+            TrialConversion.due_at <= now,
+            db.or_(
+                TrialConversion.status == 'pending',
+                db.and_(TrialConversion.status == 'processing',
+                        TrialConversion.claimed_at < now - TRIAL_CONVERSION_CLAIM_TIMEOUT)
+            )
+        ).values(status='processing', claimed_at=now, attempts=TrialConversion.attempts + 1)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    db.session.commit()
+    return claimed == 1
+
+
+def promotion_discounts(promo_code):
+    """
+    Discounts for `promo_code`; [] if it is not a valid active code. Lookup failures (network, 5xx)
+    are raised, so the conversion is retried later rather than quietly sent without the discount.
+    """
+    if not promo_code:
+        return []
+    try:
+        promo_list = stripe.PromotionCode.list(code=promo_code, active=True)
+    except stripe.error.InvalidRequestError as e:
+        logging.warning(f"Failed to validate promo code: {e}")
+        return []
+    if promo_list.data:
+        return [{"promotion_code": promo_list.data[0].id}]
+    return []
+
+
+def stripe_error_is_transient(error):
+    """
+    True if Stripe cannot have stored a definitive answer for the request (network failure, rate
+    limit, 5xx), so a retry may reuse its idempotency key.
+    """
+    if isinstance(error, (stripe.error.APIConnectionError, stripe.error.RateLimitError)):
+        return True
+    if isinstance(error, stripe.error.StripeError):
+        return error.http_status is None or error.http_status >= 500
+    return True
+
+
+def conversion_request_key(conversion):
+    # Stripe replays the stored answer to a key for 24 hours, so after a definitive error (e.g. a
+    # declined card) the next attempt must go out under a new key to be tried again at all
+    if conversion.key_revision:
+        return f"{conversion.idempotency_key}-r{conversion.key_revision}"
+    return conversion.idempotency_key
+
+
+def process_trial_conversion(conversion):
+    """
+    Claim `conversion` and create the user's subscription. Returns True once the user has a
+    subscription (from this call or an earlier one), False if the conversion isn't due or another
+    worker holds it. Stripe errors are recorded for a retry with backoff and then re-raised.
+    """
+    if conversion.status == 'done':
+        return True
+    if not claim_trial_conversion(conversion.id):
+        return False
+    db.session.refresh(conversion)
+    user = db.session.get(User, conversion.user_id)
+    if user.subscription_id:
+        # Subscribed another way (e.g. checkout) since the trial was enqueued
+        conversion.status = 'done'
+        db.session.commit()
+        return True
+    try:
+        if conversion.discounts is None:
+            conversion.discounts = promotion_discounts(user.promo_code)
+            db.session.commit()
         subscription = stripe.Subscription.create(
-            customer=current_user.stripe_customer_id,
+            customer=user.stripe_customer_id,
             items=[{"price": STRIPE_PRICE_ID}],
-            default_payment_method=current_user.stored_payment_method_id  # ensure you have this stored
+            default_payment_method=user.stored_payment_method_id,
+            discounts=conversion.discounts,
+            idempotency_key=conversion_request_key(conversion)
         )
-        current_user.subscription_id = subscription.id
-        current_user.subscription_status = subscription.status
+    except Exception as e:
+        db.session.rollback()
+        conversion = db.session.get(TrialConversion, conversion.id)
+        conversion.last_error = str(e)
+        if not stripe_error_is_transient(e):
+            # The next attempt is a new request: fresh key, parameters rebuilt from the user's current details
+            conversion.key_revision += 1
+            conversion.discounts = None
+        if conversion.attempts >= TRIAL_CONVERSION_MAX_ATTEMPTS:
+            conversion.status = 'failed'
+        else:
+            conversion.status = 'pending'
+            conversion.due_at = datetime.utcnow() + timedelta(minutes=5 * 2 ** (conversion.attempts - 1))
         db.session.commit()
-        flash("Your subscription is now active!", "success")
-    else:
-        flash("Your trial period is still active.", "info")
-    return redirect(url_for('account'))
+        raise
+    user.subscription_id = subscription.id
+    user.subscription_status = subscription.status
+    sync_stripe_subscription(subscription)
+    conversion.status = 'done'
+    conversion.last_error = None
+    db.session.commit()
+    logging.info(f"Converted trial for user {user.email}")
+    return True
+
+
+def convert_trial_for_user(user):
+    """Convert `user`'s expired trial now (login, /convert_trial); shares the queue row with the scan."""
+    conversion = schedule_trial_conversion(user)
+    db.session.commit()
+    converted = process_trial_conversion(conversion)
+    if not converted:
+        db.session.refresh(user)
+    return converted or bool(user.subscription_id)
+
 
 def convert_expired_trials():
+    """Scheduler job: process the conversions that are due, oldest first."""
     with app.app_context():
-        trial_period = timedelta(hours=1)  # Define your trial period
-        # Query for users who have a trial_start, a stored payment method, and no subscription_id
-        expired_users = User.query.filter(
-            User.trial_start.isnot(None),
-            User.stored_payment_method_id.isnot(None),
-            User.subscription_id.is_(None)
-        ).all()
-
-        for user in expired_users:
-            # Check if the trial period has expired for this user
-            if datetime.utcnow() >= user.trial_start + trial_period:
-                try:
-                    # Create the subscription (no trial period)
-                    subscription = stripe.Subscription.create(
-                        customer=user.stripe_customer_id,
-                        items=[{"price": STRIPE_PRICE_ID}],
-                        default_payment_method=user.stored_payment_method_id
-                    )
-                    user.subscription_id = subscription.id
-                    user.subscription_status = subscription.status
-                    db.session.commit()
-                    logging.info(f"Converted trial for user {user.email}")
-                except Exception as e:
-                    logging.error(f"Error converting trial for user {user.email}: {e}")
+        due = TrialConversion.query.filter(
+            TrialConversion.status == 'pending',
+            TrialConversion.due_at <= datetime.utcnow()
+        ).order_by(TrialConversion.due_at).limit(TRIAL_CONVERSION_BATCH).all()
+
+        for conversion in due:
+            try:
+                process_trial_conversion(conversion)
+            except Exception as e:
+                logging.error(f"Error converting trial for user {conversion.user_id}: {e}")
 
 @app.route('/payment_success')
 @login_required
@@ -1282,6 +2481,7 @@ def payment_success():
         current_user.stripe_customer_id = stripe_customer_id
         current_user.subscription_id = subscription_id
         current_user.subscription_status = subscription.status
+        sync_stripe_subscription(subscription)
         db.session.commit()
 
         subject = "Subscription Confirmation"
@@ -1290,7 +2490,8 @@ def payment_success():
             "Best regards,\nThe Support Team"
         )
         logging.debug(f"Trying to send to {to_address}")
-        send_email_via_brevo(subject, body, current_user.email)
+        queue_email(subject, body, current_user.email)
+        db.session.commit()
 
         flash("Subscription updated successfully!", "success")
         return redirect(url_for('account'))
@@ -1301,14 +2502,18 @@ def payment_success():
 @app.route('/cancel_trial')
 @login_required
 def cancel_trial():
-    # Get the current user from the database
-    user = User.query.get(current_user.id)
+    # Get the current user's row
+    user = current_user_row()
     if user:
         # Update the subscription status (or set an "active" flag to False)
         user.subscription_status = "cancelled"
         # Optionally, clear trial_start and stored_payment_method_id if needed:
         user.trial_start = None
         user.stored_payment_method_id = None
+        TrialConversion.query.filter(
+            TrialConversion.user_id == user.id,
+            TrialConversion.status.in_(('pending', 'processing'))
+        ).update({"status": "cancelled"}, synchronize_session=False)
         db.session.commit()
     # Log the user out after updating the account
     logout_user()
@@ -1323,9 +2528,7 @@ def payment_cancel():
 @app.route('/logout')
 @login_required
 def logout():
-    session.pop('conversation', None)
-    session.pop('feedback', None)
-    session.pop('feedback_json', None)
+    session.pop('simulation_id', None)
     session.pop('hint', None)
     logout_user()
     return redirect(url_for('landing'))
@@ -1357,7 +2560,8 @@ def forgot_password():
 </html>
 """
             try:
-                send_email_via_brevo("Password Reset Request", html_body, email, html=True)
+                queue_email("Password Reset Request", html_body, email, html=True)
+                db.session.commit()
                 flash("A password reset link has been sent to your email. **Please check your SPAM folder**", "info")
             except Exception as e:
                 flash(f"Error sending email: {str(e)}", "danger")
@@ -1398,17 +2602,49 @@ def reset_password(token):
     return render_template('reset_password.html', token=token)
 
 
-# --- Simulation and Messaging Routes ---
-@app.route('/start_simulation', methods=['POST'])
-@login_required
-def start_simulation():
-    problem_complexity = request.form.get('problem_complexity')
-    patient_complexity = request.form.get('patient_complexity')
-    nomenclature = request.form.get('drug_nomenclature', 'BNF')
-    system_choice = request.form.get('system', 'random')
-    comorbidities = request.form.get('comorbidities', 'no')
-    session['comorbidities'] = comorbidities
+# --- Conversation Store ---
+# Transcripts are stored one row per turn, keyed by simulation id; the session only holds the id.
+def start_conversation(messages):
+    """Start a new simulation for the current user with `messages` as its opening turns."""
+    simulation_id = str(uuid.uuid4())
+    db.session.add(Simulation(id=simulation_id, user_id=current_user.id))
+    for message in messages:
+        db.session.add(ConversationTurn(simulation_id=simulation_id, role=message['role'], content=message['content']))
+    db.session.commit()
+    session['simulation_id'] = simulation_id
+    return simulation_id
+
 
+def get_conversation_turns(simulation_id=None):
+    """Like get_conversation(), but each message also carries its turn 'id'."""
+    simulation_id = simulation_id or session.get('simulation_id')
+    if not simulation_id:
+        return []
+    turns = db.session.query(ConversationTurn.id, ConversationTurn.role, ConversationTurn.content).filter(
+        ConversationTurn.simulation_id == simulation_id
+    ).order_by(ConversationTurn.id).all()
+    return [{'id': turn_id, 'role': role, 'content': content} for turn_id, role, content in turns]
+
+
+def get_conversation(simulation_id=None):
+    return [{'role': m['role'], 'content': m['content']} for m in get_conversation_turns(simulation_id)]
+
+
+def append_turn(role, content, simulation_id=None):
+    simulation_id = simulation_id or session.get('simulation_id')
+    if not simulation_id:
+        return start_conversation([{'role': role, 'content': content}])
+    db.session.add(ConversationTurn(simulation_id=simulation_id, role=role, content=content))
+    db.session.commit()
+    return simulation_id
+
+
+# --- Simulation and Messaging Routes ---
+def build_scenario(system_choice, problem_complexity, patient_complexity, comorbidities, nomenclature):
+    """
+    Choose the patient, presenting complaint and comorbidities for a new simulation and build
+    the patient's system prompt. Returns a dict with 'instr', 'patient' and 'selected_complaint'.
+    """
     if comorbidities.lower() == "yes+":
         system_conditions = {
             "cardiovascular": [
@@ -1537,13 +2773,6 @@ def start_simulation():
     else:
         comorbidity_details = " This patient does not have any co-morbidities."
 
-    if patient_complexity not in ['Nil', 'Memory Issues', 'Frustrated']:
-        flash("Invalid patient complexity selected.", "danger")
-        return redirect(url_for('simulation'))
-    if not nomenclature:
-        flash("Please select a drug naming standard.", "danger")
-        return redirect(url_for('simulation'))
-
     if patient_complexity == "Nil":
         tone = " Always use natural patient friendly language throughout as a common person would. Avoid jargon"
     elif patient_complexity == "Memory Issues":
@@ -1571,19 +2800,13 @@ def start_simulation():
         complaints = SYSTEM_COMPLAINTS.get(system_choice, [])
         selected_complaint = random.choice(complaints) if complaints else "No complaint available."
 
-    session['system_choice'] = system_choice
-    session['selected_complaint'] = selected_complaint
-    session['problem_complexity'] = problem_complexity
-    session['patient_complexity'] = patient_complexity
-    session['nomenclature'] = nomenclature
-
     instr = (
             f"You are a patient in a history-taking simulation using the {nomenclature} drug naming standard. "
             f"Your problem complexity is {problem_complexity} and your patient complexity is {patient_complexity}. "
             f"Your name is {patient['name']} (age {patient['age']}) and you are a {patient['gender']} patient."
             + comorbidity_details + " " +
             "At the very beginning of the consultation, your initial response is: "
-            "\"Can I speak with someone about my symptoms?\". Once you have provided that opener, "
+            f"\"{PATIENT_OPENER}\". Once you have provided that opener, "
             "continue the conversation naturally without repeating the phrase. Consent to answering questions regardless of the interviewer's profession. "
             f"Present your complaint: {selected_complaint}. "
             "Provide only minimal details until further questions are asked, then gradually add more information. "
@@ -1594,27 +2817,180 @@ def start_simulation():
             + tone
     )
 
-    session['conversation'] = [{'role': 'system', 'content': instr}]
-    logging.debug("DEBUG: Conversation initialized with prompt:", session['conversation'])
+    return {"instr": instr, "patient": patient, "selected_complaint": selected_complaint}
+
+
+# --- Scenario Pool ---
+# Ready-made scenarios per (system, problem complexity, patient complexity, comorbidities, nomenclature)
+# so that starting a case is a pool pop. With FAST_START=false the pool also pre-generates the
+# patient's first model turn, which is billed to the user who takes the scenario.
+SCENARIO_POOL_ENABLED = os.getenv("SCENARIO_POOL_ENABLED", "true").lower() == "true"
+SCENARIO_POOL_SIZE = int(os.getenv("SCENARIO_POOL_SIZE", "3"))  # scenarios kept ready per key
+SCENARIO_POOL_REFILL_SECONDS = int(os.getenv("SCENARIO_POOL_REFILL_SECONDS", "15"))
+SCENARIO_POOL_REFILL_BATCH = int(os.getenv("SCENARIO_POOL_REFILL_BATCH", "5"))  # max scenarios built per refill
+SCENARIO_POOL_MAX_KEYS = int(os.getenv("SCENARIO_POOL_MAX_KEYS", "50"))  # least recently asked-for keys dropped beyond this
+SCENARIO_POOL_KEY_IDLE_SECONDS = int(os.getenv("SCENARIO_POOL_KEY_IDLE_SECONDS", "3600"))  # stop refilling keys nobody asks for
+
+# Only the options offered on the simulation page are pooled; anything else is built on demand so
+# that arbitrary form values cannot each start a pool that is refilled (and warmed up) forever
+SCENARIO_POOL_OPTIONS = (
+    {'random', *SYSTEM_COMPLAINTS},                                    # system
+    {None},                                                            # problem complexity (not on the form)
+    {'Nil', 'Memory Issues', 'Frustrated'},                            # patient complexity
+    {'no', 'yes', 'yes+'},                                             # comorbidities
+    {'BNF', 'USAN', 'INN', 'AAN', 'HealthCanada', 'ChinesePharm'},     # nomenclature
+)
 
-    try:
-        response = openai.ChatCompletion.create(
-            model="gpt-4-turbo",
-            messages=session['conversation'],
-            temperature=0.8
-        )
-        first_reply = response.choices[0].message["content"]
-        if response.usage and 'prompt_tokens' in response.usage and 'completion_tokens' in response.usage:
-            current_user.token_prompt_usage_gpt4 = (current_user.token_prompt_usage_gpt4 or 0) + response.usage[
-                'prompt_tokens']
-            current_user.token_completion_usage_gpt4 = (current_user.token_completion_usage_gpt4 or 0) + response.usage[
-                'completion_tokens']
-            db.session.commit()
-    except Exception as e:
-        first_reply = f"Error with API: {str(e)}"
-    session['conversation'].append({'role': 'assistant', 'content': first_reply})
-    logging.debug("DEBUG: After first reply, conversation state:", session['conversation'])
-    session.pop('feedback', None)
+
+def is_poolable_scenario(key):
+    return all(value in options for value, options in zip(key, SCENARIO_POOL_OPTIONS))
+
+
+class ScenarioPool:
+    def __init__(self, size, refill_batch, max_keys, idle_seconds):
+        self.size = size
+        self.refill_batch = refill_batch
+        self.max_keys = max_keys
+        self.idle_seconds = idle_seconds
+        self._lock = threading.Lock()
+        self._pools = collections.OrderedDict()  # least recently asked-for key first
+        self._last_asked = {}
+        self.counters = {"hits": 0, "misses": 0, "generated": 0, "warmup_failures": 0, "expired_keys": 0}
+
+    def pop(self, key):
+        """Take a ready scenario for `key`, or None on a miss. Keys are refilled once they have been asked for."""
+        with self._lock:
+            pool = self._pools.get(key)
+            if pool is None:
+                pool = self._pools[key] = collections.deque()
+                while len(self._pools) > self.max_keys:
+                    self._drop(next(iter(self._pools)))
+            self._pools.move_to_end(key)
+            self._last_asked[key] = time.monotonic()
+            if pool:
+                self.counters["hits"] += 1
+                return pool.popleft()
+            self.counters["misses"] += 1
+            return None
+
+    def _drop(self, key):
+        del self._pools[key]
+        del self._last_asked[key]
+        self.counters["expired_keys"] += 1
+
+    def refill(self):
+        with self._lock:
+            cutoff = time.monotonic() - self.idle_seconds
+            for key in [key for key, asked in self._last_asked.items() if asked < cutoff]:
+                self._drop(key)
+            wanted = [(key, self.size - len(pool)) for key, pool in self._pools.items() if len(pool) < self.size]
+        built = 0
+        for key, missing in wanted:
+            for _ in range(missing):
+                if built >= self.refill_batch:
+                    return
+                scenario = build_scenario(*key)
+                if not FAST_START:
+                    self._warm_up(scenario)
+                with self._lock:
+                    pool = self._pools.get(key)
+                    if pool is None:  # dropped while this one was being built
+                        break
+                    pool.append(scenario)
+                    self.counters["generated"] += 1
+                built += 1
+
+    def _warm_up(self, scenario):
+        try:
+            response = llm_client.chat(
+                "start_simulation",
+                "gpt-4-turbo",
+                [{'role': 'system', 'content': scenario['instr']}],
+                temperature=0.8
+            )
+            scenario['first_reply'] = response.choices[0].message["content"]
+            scenario['usage'] = dict(response.usage) if response.usage else None
+        except Exception as e:
+            with self._lock:
+                self.counters["warmup_failures"] += 1
+            logging.warning(f"Scenario pool warm-up failed: {e}")
+
+    def snapshot(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats["ready"] = sum(len(pool) for pool in self._pools.values())
+            stats["keys"] = len(self._pools)
+        return stats
+
+
+scenario_pool = ScenarioPool(SCENARIO_POOL_SIZE, SCENARIO_POOL_REFILL_BATCH, SCENARIO_POOL_MAX_KEYS,
+                             SCENARIO_POOL_KEY_IDLE_SECONDS)
+
+
+def refill_scenario_pool():
+    if SCENARIO_POOL_ENABLED:
+        scenario_pool.refill()
+
+
+@app.route('/start_simulation', methods=['POST'])
+@login_required
+def start_simulation():
+    problem_complexity = request.form.get('problem_complexity')
+    patient_complexity = request.form.get('patient_complexity')
+    nomenclature = request.form.get('drug_nomenclature', 'BNF')
+    system_choice = request.form.get('system', 'random')
+    comorbidities = request.form.get('comorbidities', 'no')
+    session['comorbidities'] = comorbidities
+
+    if patient_complexity not in ['Nil', 'Memory Issues', 'Frustrated']:
+        flash("Invalid patient complexity selected.", "danger")
+        return redirect(url_for('simulation'))
+    if not nomenclature:
+        flash("Please select a drug naming standard.", "danger")
+        return redirect(url_for('simulation'))
+
+    key = (system_choice, problem_complexity, patient_complexity, comorbidities.lower(), nomenclature)
+    scenario = scenario_pool.pop(key) if SCENARIO_POOL_ENABLED and is_poolable_scenario(key) else None
+    if scenario is None:
+        scenario = build_scenario(*key)
+    instr = scenario['instr']
+    selected_complaint = scenario['selected_complaint']
+
+    session['system_choice'] = system_choice
+    session['selected_complaint'] = selected_complaint
+    session['problem_complexity'] = problem_complexity
+    session['patient_complexity'] = patient_complexity
+    session['nomenclature'] = nomenclature
+
+    conversation = [{'role': 'system', 'content': instr}]
+    logging.debug("DEBUG: Conversation initialized with prompt:", conversation)
+
+    if scenario.get('first_reply'):
+        # Warmed up in the scenario pool; charge the pre-generated turn to this user
+        first_reply = scenario['first_reply']
+        usage = scenario.get('usage')
+        if usage:
+            record_token_usage(current_user.id, "gpt-4-turbo", usage.get('prompt_tokens', 0),
+                               usage.get('completion_tokens', 0))
+    elif FAST_START:
+        # The first real model call happens when the student asks their first question
+        first_reply = PATIENT_OPENER
+    else:
+        try:
+            response = llm_client.chat(
+                "start_simulation",
+                "gpt-4-turbo",
+                conversation,
+                user_id=current_user.id,
+                temperature=0.8
+            )
+            first_reply = response.choices[0].message["content"]
+            record_response_usage(current_user.id, "gpt-4-turbo", response)
+        except Exception as e:
+            first_reply = f"Error with API: {str(e)}"
+    conversation.append({'role': 'assistant', 'content': first_reply})
+    start_conversation(conversation)
+    logging.debug("DEBUG: After first reply, conversation state:", conversation)
     session.pop('hint', None)
     return redirect(url_for('simulation'))
 
@@ -1622,57 +2998,63 @@ def start_simulation():
 @app.route('/simulation', methods=['GET'])
 @login_required
 def simulation():
-    conversation = session.get('conversation', [])
+    conversation = get_conversation()
     display_conv = [m for m in conversation if m['role'] != 'system']
     safe_display_conv = repr(display_conv).encode('utf-8', errors='replace').decode('utf-8')
     try:
         logging.debug("DEBUG: Display conversation (without system messages):", safe_display_conv)
     except OSError as e:
         logging.debug("DEBUG: Error printing conversation:", e)
+    report = get_feedback_report()
+    feedback_ready = report is not None and report.status in ('done', 'failed')
     return render_template(
         'simulation.html',
         conversation=display_conv,
-        feedback_json=session.get('feedback_json'),
-        feedback_raw=session.get('feedback'),
+        feedback_json=report.feedback_json if feedback_ready else None,
+        feedback_raw=report.feedback_raw if feedback_ready else None,
+        feedback_pending=report is not None and not feedback_ready,
+        feedback_poll_ms=FEEDBACK_POLL_MS,
         hint=session.get('hint')
     )
 
 
+def validate_chat_message(msg):
+    """Return an error message if the user's chat input should be rejected, otherwise None."""
+    generic_phrases = ["i need help", "help", "assist", "???", "??", "?"]
+    forced_context_phrases = ["i am the patient", "i'm the patient", "i am the clinician", "i'm the clinician"]
+
+    if not msg:
+        return "No message provided"
+    stripped_msg = msg.strip()
+    lower_msg = stripped_msg.lower()
+    if (len(stripped_msg) < 3 or
+            lower_msg in generic_phrases or
+            not re.search(r"[aeiou]", stripped_msg) or
+            any(phrase in lower_msg for phrase in forced_context_phrases)):
+        return "No valid input detected. Please try again."
+    return None
+
+
 @app.route('/send_message', methods=['POST'])
 @csrf.exempt
 @login_required
 def send_message():
-    conversation = session.get('conversation', [])
     msg = request.form.get('message')
-    generic_phrases = ["i need help", "help", "assist", "???", "??", "?"]
-    forced_context_phrases = ["i am the patient", "i'm the patient", "i am the clinician", "i'm the clinician"]
-
-    if msg:
-        stripped_msg = msg.strip()
-        lower_msg = stripped_msg.lower()
-        if (len(stripped_msg) < 3 or
-                lower_msg in generic_phrases or
-                not re.search(r"[aeiou]", stripped_msg) or
-                any(phrase in lower_msg for phrase in forced_context_phrases)):
-            return jsonify({"status": "error", "message": "No valid input detected. Please try again."}), 400
-
-        conversation.append({'role': 'user', 'content': msg})
-        session['conversation'] = conversation
-        session.pop('hint', None)
-        logging.debug("DEBUG: After user message added, conversation:", session['conversation'])
-        return jsonify({"status": "ok"}), 200
+    error = validate_chat_message(msg)
+    if error:
+        return jsonify({"status": "error", "message": error}), 400
 
-    return jsonify({"status": "error", "message": "No message provided"}), 400
+    append_turn('user', msg)
+    session.pop('hint', None)
+    logging.debug("DEBUG: User message added to simulation:", session.get('simulation_id'))
+    return jsonify({"status": "ok"}), 200
 
 
-@app.route('/get_reply', methods=['POST'])
-@csrf.exempt
-@login_required
-def get_reply():
-    conversation = session.get('conversation', [])
+def add_reinforcement_message(conversation):
+    # Added to the prompt only (never stored), from the third user message onwards
     user_message_count = sum(1 for m in conversation if m.get('role') == 'user')
 
-    if user_message_count > 0 and user_message_count % 3 == 0:
+    if user_message_count >= 3:
         reinforcement_message = ("REINFORCEMENT: You are a patient in a history-taking simulation. "
                                  "Remember: You must NEVER provide clinical advice or act as a clinician. "
                                  "Remain strictly in character as a patient.")
@@ -1681,57 +3063,268 @@ def get_reply():
             conversation.insert(insert_index, {'role': 'system', 'content': reinforcement_message})
             logging.debug("DEBUG: Reinforcement message inserted.")
 
-    logging.debug("DEBUG: Before get_reply, conversation:", conversation)
 
+# --- Context Window Management ---
+# Patient replies are generated from the system prompt, a rolling summary of older turns and the
+# most recent turns verbatim, so prompt size stays flat however long the consultation runs.
+CONTEXT_KEEP_TURNS = int(os.getenv("CONTEXT_KEEP_TURNS", "12"))  # recent turns always sent verbatim
+# Older turns are folded into the summary in batches of at least this many, not on every reply
+CONTEXT_SUMMARY_BATCH = int(os.getenv("CONTEXT_SUMMARY_BATCH", "8"))
+CONTEXT_SUMMARY_MAX_TOKENS = int(os.getenv("CONTEXT_SUMMARY_MAX_TOKENS", "300"))
+# Hard cap on estimated prompt tokens per model; the oldest verbatim turns are dropped beyond it
+CONTEXT_TOKEN_BUDGETS = {
+    "gpt-3.5-turbo": int(os.getenv("CONTEXT_TOKEN_BUDGET_GPT35", "3000")),
+    "gpt-4-turbo": int(os.getenv("CONTEXT_TOKEN_BUDGET_GPT4", "12000")),
+}
+
+SUMMARY_INSTRUCTION = (
+    "You are summarising a history-taking consultation between a clinician (User) and a patient (Patient) "
+    "so that the patient can stay consistent later on. Update the existing summary with the new dialogue. "
+    "Record every fact the patient has disclosed (symptoms, timings, history, medicines, allergies, social and "
+    "family history), what the clinician has asked, examined or explained, and the patient's mood. "
+    "Write in the third person, in British English, in no more than 200 words."
+)
+
+
+def is_unsummarized(message, summarized_through):
+    return message.get('id') is None or message['id'] > summarized_through
+
+
+def compact_conversation(messages, summary, summarized_through, model):
+    """
+    Build the prompt for `model` from stored messages: all system messages, the rolling summary
+    (if any) and the dialogue turns newer than `summarized_through`. Messages without an 'id'
+    have not been stored yet and always count as new.
+    """
+    system = [m for m in messages if m['role'] == 'system']
+    dialogue = [m for m in messages if m['role'] != 'system' and is_unsummarized(m, summarized_through)]
+    if summary:
+        system.append({'role': 'system', 'content': "Summary of the consultation so far: " + summary})
+    budget = CONTEXT_TOKEN_BUDGETS.get(model)
+    if budget:
+        while len(dialogue) > 1 and estimate_message_tokens(system + dialogue) > budget:
+            dialogue.pop(0)
+    return [{'role': m['role'], 'content': m['content']} for m in system + dialogue]
+
+
+def build_patient_prompt(turns, model="gpt-3.5-turbo"):
+    """
+    Prompt for the next patient reply. Schedules a background summary update once enough
+    turns have built up beyond the verbatim window.
+    """
+    simulation_id = session.get('simulation_id')
+    simulation = db.session.get(Simulation, simulation_id) if simulation_id else None
+    summary = simulation.summary if simulation else None
+    summarized_through = (simulation.summarized_through or 0) if simulation else 0
+
+    add_reinforcement_message(turns)
+    unsummarized = sum(1 for m in turns if m['role'] != 'system' and is_unsummarized(m, summarized_through))
+    if simulation and unsummarized > CONTEXT_KEEP_TURNS + CONTEXT_SUMMARY_BATCH:
+        run_soon(update_conversation_summary, f"summary-{simulation_id}", simulation_id)
+    return compact_conversation(turns, summary, summarized_through, model)
+
+
+def update_conversation_summary(simulation_id):
+    """Fold all but the last CONTEXT_KEEP_TURNS unsummarised turns into the simulation's summary."""
+    with app.app_context():
+        simulation = db.session.get(Simulation, simulation_id)
+        if not simulation:
+            return
+        turns = ConversationTurn.query.filter(
+            ConversationTurn.simulation_id == simulation_id,
+            ConversationTurn.role != 'system',
+            ConversationTurn.id > (simulation.summarized_through or 0)
+        ).order_by(ConversationTurn.id).all()
+        if len(turns) <= CONTEXT_KEEP_TURNS + CONTEXT_SUMMARY_BATCH:
+            return
+        to_fold = turns[:-CONTEXT_KEEP_TURNS]
+        transcript = "\n".join(
+            f"{'User' if t.role == 'user' else 'Patient'}: {t.content}" for t in to_fold
+        )
+        summary_prompt = (
+            SUMMARY_INSTRUCTION
+            + "\n\nExisting summary:\n" + (simulation.summary or "(none)")
+            + "\n\nNew dialogue:\n" + transcript
+        )
+        try:
+            response = llm_client.chat(
+                "summarise",
+                "gpt-3.5-turbo",
+                [{'role': 'system', 'content': summary_prompt}],
+                user_id=simulation.user_id,
+                simulation_id=simulation_id,
+                temperature=0.2,
+                max_tokens=CONTEXT_SUMMARY_MAX_TOKENS
+            )
+        except Exception as e:
+            logging.warning(f"Conversation summary failed for simulation {simulation_id}: {e}")
+            return
+        simulation.summary = response.choices[0].message["content"].strip()
+        simulation.summarized_through = to_fold[-1].id
+        db.session.commit()
+        record_response_usage(simulation.user_id, "gpt-3.5-turbo", response)
+        logging.debug(f"Summarised {len(to_fold)} turns for simulation {simulation_id}")
+
+
+# --- Streaming Helpers ---
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+# In-character replies used when OpenAI is failing; these are shown to the user but never
+# added to the conversation, so they are not fed back into later prompts
+PATIENT_FALLBACK_REPLIES = [
+    "Sorry, I lost my train of thought for a moment. Could you ask me that again?",
+    "I'm sorry, I didn't quite catch that. Could you repeat the question?",
+    "Sorry, my mind went blank there. What was it you asked?",
+]
+
+
+def patient_fallback_reply():
+    return random.choice(PATIENT_FALLBACK_REPLIES)
+
+
+def generate_patient_reply(conversation):
+    """Return (reply, is_fallback). Fallback replies must not be saved to the conversation."""
     try:
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
-            messages=conversation,
+        response = llm_client.chat(
+            request.endpoint,
+            "gpt-3.5-turbo",
+            conversation,
+            user_id=current_user.id,
+            simulation_id=session.get('simulation_id'),
             temperature=0.8
         )
         resp_text = response.choices[0].message["content"]
-        if response.usage and 'prompt_tokens' in response.usage and 'completion_tokens' in response.usage:
-            current_user.token_prompt_usage_gpt35 = (current_user.token_prompt_usage_gpt35 or 0) + response.usage[
-                'prompt_tokens']
-            current_user.token_completion_usage_gpt35 = (current_user.token_completion_usage_gpt35 or 0) + \
-                                                        response.usage['completion_tokens']
-            db.session.commit()
+        record_response_usage(current_user.id, "gpt-3.5-turbo", response)
     except openai.error.OpenAIError as e:
-        resp_text = f"OpenAI API Error: {str(e)}"
+        logging.error(f"OpenAI API Error in {request.endpoint}: {e}")
+        return patient_fallback_reply(), True
     except Exception as e:
-        resp_text = f"Unexpected Error: {str(e)}"
+        logging.error(f"Unexpected Error in {request.endpoint}: {e}")
+        return patient_fallback_reply(), True
+    return resp_text, False
+
+
+def stream_patient_reply(conversation):
+    user_id = current_user.id
+    route = request.endpoint
+    simulation_id = session.get('simulation_id')
+
+    def generate():
+        parts = []
+        try:
+            response = llm_client.chat(
+                route,
+                "gpt-3.5-turbo",
+                conversation,
+                user_id=user_id,
+                simulation_id=simulation_id,
+                temperature=0.8,
+                stream=True
+            )
+            for chunk in response:
+                delta = chunk.choices[0].delta.get("content")
+                if delta:
+                    parts.append(delta)
+                    yield sse_event("delta", {"content": delta})
+            resp_text = "".join(parts)
+            record_token_usage(user_id, "gpt-3.5-turbo", estimate_message_tokens(conversation, "gpt-3.5-turbo"),
+                               estimate_tokens(resp_text, "gpt-3.5-turbo"))
+        except openai.error.OpenAIError as e:
+            logging.error(f"OpenAI API Error in {route}: {e}")
+            yield sse_event("done", {"reply": patient_fallback_reply(), "fallback": True})
+            return
+        except Exception as e:
+            logging.error(f"Unexpected Error in {route}: {e}")
+            yield sse_event("done", {"reply": patient_fallback_reply(), "fallback": True})
+            return
+
+        append_turn('assistant', resp_text, simulation_id)
+        logging.debug("DEBUG: After streamed reply, simulation:", simulation_id)
+        yield sse_event("done", {"reply": resp_text})
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+
+@app.route('/get_reply', methods=['POST'])
+@csrf.exempt
+@login_required
+def get_reply():
+    conversation = build_patient_prompt(get_conversation_turns())
+
+    logging.debug("DEBUG: Before get_reply, conversation:", conversation)
+
+    if STREAM_REPLIES and request.args.get('stream') == '1':
+        return stream_patient_reply(conversation)
+
+    resp_text, is_fallback = generate_patient_reply(conversation)
+    if not is_fallback:
+        append_turn('assistant', resp_text)
+    logging.debug("DEBUG: After get_reply, reply:", resp_text)
+    return jsonify({"reply": resp_text, "fallback": is_fallback}), 200
+
 
-    conversation.append({'role': 'assistant', 'content': resp_text})
-    session['conversation'] = conversation
-    logging.debug("DEBUG: After get_reply, conversation:", conversation)
-    return jsonify({"reply": resp_text}), 200
+@app.route('/chat_turn', methods=['POST'])
+@csrf.exempt
+@login_required
+def chat_turn():
+    """
+    One round trip per user turn: validates the message with the same rules as
+    send_message, generates the patient's reply and saves both to the conversation store.
+    """
+    msg = request.form.get('message')
+    error = validate_chat_message(msg)
+    if error:
+        return jsonify({"status": "error", "message": error}), 400
+
+    turns = get_conversation_turns()
+    append_turn('user', msg)
+    turns.append({'role': 'user', 'content': msg})
+    session.pop('hint', None)
+    conversation = build_patient_prompt(turns)
+
+    if STREAM_REPLIES and request.args.get('stream') == '1':
+        return stream_patient_reply(conversation)
+
+    resp_text, is_fallback = generate_patient_reply(conversation)
+    if not is_fallback:
+        append_turn('assistant', resp_text)
+    logging.debug("DEBUG: After chat_turn, reply:", resp_text)
+    return jsonify({"status": "ok", "reply": resp_text, "fallback": is_fallback}), 200
 
 
 @app.route('/hint', methods=['POST'])
 @login_required
 def hint():
-    conversation = session.get('conversation', [])
+    conversation = get_conversation()
     if not conversation:
         flash("No conversation available for hint suggestions", "warning")
         return redirect(url_for('simulation'))
-    conv_text = "\n".join([f"{'User' if m['role'] == 'user' else 'Patient'}: {m['content']}" for m in conversation if
-                           m['role'] != 'system'])
+    conv_lines = [f"{'User' if m['role'] == 'user' else 'Patient'}: {m['content']}" for m in conversation if
+                  m['role'] != 'system']
+    # Long transcripts keep their most recent lines so the hint prompt stays within budget
+    transcript_budget = llm_client.prompt_budget_for("hint") - estimate_message_tokens(
+        [{'role': 'system', 'content': PROMPT_INSTRUCTION}], "gpt-3.5-turbo")
+    conv_text = "\n".join(tail_lines_within(conv_lines, transcript_budget, "gpt-3.5-turbo"))
     hint_text = PROMPT_INSTRUCTION + "\n" + conv_text
     hint_conversation = [{'role': 'system', 'content': hint_text}]
     logging.debug("DEBUG: Hint prompt constructed:", hint_text)
     try:
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
-            messages=hint_conversation,
+        response = llm_client.chat(
+            "hint",
+            "gpt-3.5-turbo",
+            hint_conversation,
+            user_id=current_user.id,
+            simulation_id=session.get('simulation_id'),
             temperature=0.8
         )
         hint_response = response.choices[0].message["content"]
-        if response.usage and 'prompt_tokens' in response.usage and 'completion_tokens' in response.usage:
-            current_user.token_prompt_usage_gpt35 = (current_user.token_prompt_usage_gpt35 or 0) + response.usage[
-                'prompt_tokens']
-            current_user.token_completion_usage_gpt35 = (current_user.token_completion_usage_gpt35 or 0) + \
-                                                        response.usage['completion_tokens']
-            db.session.commit()
+        record_response_usage(current_user.id, "gpt-3.5-turbo", response)
     except Exception as e:
         hint_response = f"Error with API: {str(e)}"
     session['hint'] = hint_response
@@ -1739,23 +3332,33 @@ def hint():
     return redirect(url_for('simulation'))
 
 
-@app.route('/feedback', methods=['POST'])
-@login_required
-def feedback():
-    # Check if feedback has already been provided in this session
-    if session.get('feedback_given'):
-        flash("Feedback has already been provided in this session.", "warning")
-        return redirect(url_for('simulation'))
+# --- Feedback Reports ---
+# Grading a consultation is the slowest model call in the app, so /feedback only records a pending
+# FeedbackReport and hands it to the scheduler; simulation.html polls /feedback_status until it is ready.
+FEEDBACK_JOB_TIMEOUT = timedelta(seconds=int(os.getenv("FEEDBACK_JOB_TIMEOUT_SECONDS", "180")))
+FEEDBACK_MAX_ATTEMPTS = int(os.getenv("FEEDBACK_MAX_ATTEMPTS", "2"))
+FEEDBACK_POLL_MS = int(os.getenv("FEEDBACK_POLL_MS", "2000"))
+
+# The seven scored Calgary–Cambridge categories, in report order
+FEEDBACK_CATEGORIES = {
+    "initiating_session": "Initiating the session",
+    "gathering_information": "Gathering information",
+    "physical_examination": "Physical examination",
+    "explanation_planning": "Explanation & planning",
+    "closing_session": "Closing the session",
+    "building_relationship": "Building a relationship",
+    "providing_structure": "Providing structure",
+}
+_FEEDBACK_KEY_STOPWORDS = {"the", "a", "and"}
+_SMART_QUOTES = str.maketrans({"\u201c": '"', "\u201d": '"', "\u2018": "'", "\u2019": "'"})
 
-    conversation = session.get('conversation', [])
-    if not conversation:
-        flash("No conversation available for feedback", "warning")
-        return redirect(url_for('simulation'))
+# How each report's JSON was obtained; served by /admin/metrics
+_feedback_parse_lock = threading.Lock()
+feedback_parse_counters = {"parsed": 0, "repaired": 0, "requeried": 0, "failed": 0}
 
-    user_conv_text = "\n".join(
-        [f"User: {m['content']}" for m in conversation if m.get('role') == 'user']
-    )
-    feedback_prompt = (
+
+def build_feedback_prompt(user_conv_text):
+    return (
         "IMPORTANT: Output ONLY valid JSON with NO disclaimers or additional commentary. "
         "Your answer MUST start with '{' and end with '}'. Use double quotes for all keys and string values, "
         "and do NOT use single quotes. Evaluate the following consultation transcript using the Calgary–Cambridge model. "
@@ -1784,174 +3387,406 @@ def feedback():
         "The consultation transcript is:\n" + user_conv_text
     )
 
-    feedback_conversation = [{'role': 'system', 'content': feedback_prompt}]
-    logging.debug("DEBUG: Feedback prompt constructed:", feedback_prompt)
+
+def build_feedback_followup_prompt(missing, user_conv_text):
+    fields = []
+    for key in missing:
+        if key in FEEDBACK_CATEGORIES:
+            fields.append(f'  "{key}": {{"score": X, "comment": "..."}}  ({FEEDBACK_CATEGORIES[key]}, scored 1 to 10)')
+        else:
+            fields.append(f'  "{key}": "..."  (commentary on the user\'s diagnostic accuracy and clinical reasoning)')
+    return (
+        "IMPORTANT: Output ONLY a valid JSON object with NO additional commentary, containing exactly these keys. "
+        "Evaluate the following consultation transcript using the Calgary–Cambridge model:\n"
+        "{\n" + ",\n".join(fields) + "\n}\n\n"
+        "The consultation transcript is:\n" + user_conv_text
+    )
+
+
+def record_feedback_parse(outcome):
+    with _feedback_parse_lock:
+        feedback_parse_counters[outcome] += 1
+
+
+def feedback_parse_snapshot():
+    with _feedback_parse_lock:
+        stats = dict(feedback_parse_counters)
+    total = sum(stats.values())
+    # Share of reports usable straight from the model, and share usable at all
+    stats["parse_success_rate"] = round(stats["parsed"] / total, 3) if total else None
+    stats["usable_rate"] = round((total - stats["failed"]) / total, 3) if total else None
+    return stats
+
+
+def close_truncated_json(text):
+    """Close the strings, objects and arrays left open by output cut off at max_tokens."""
+    stack = []
+    in_string = escaped = False
+    for char in text:
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char in "{[":
+            stack.append("}" if char == "{" else "]")
+        elif char in "}]" and stack:
+            stack.pop()
+    if in_string:
+        text += '"'
+    # Drop a dangling separator or a key that never got its value
+    text = re.sub(r'([{,])\s*"[^"]*"\s*:?\s*$', r"\1", text.rstrip())
+    text = re.sub(r",\s*$", "", text)
+    return text + "".join(reversed(stack))
+
+
+def load_feedback_json(text):
+    """
+    Parse the model's feedback into a dict. Returns (data, repaired), with data None if nothing
+    usable could be recovered. Near-misses (code fences, surrounding prose, smart or single quotes,
+    trailing commas, output truncated at max_tokens) are repaired locally.
+    """
     try:
-        response = openai.ChatCompletion.create(
-            model="gpt-4-turbo",
-            messages=feedback_conversation,
-            temperature=0.8,
-            max_tokens=500
+        data = json.loads(text)
+        if isinstance(data, dict):
+            return data, False
+    except (TypeError, ValueError):
+        pass
+    if not isinstance(text, str):
+        return None, False
+    candidate = text.strip()
+    fenced = re.search(r"```(?:json)?\s*(.*?)(?:```|$)", candidate, re.S)
+    if fenced:
+        candidate = fenced.group(1)
+    start = candidate.find("{")
+    if start == -1:
+        return None, False
+    candidate = re.sub(r",\s*([}\]])", r"\1", candidate[start:].translate(_SMART_QUOTES))
+    # Either a complete object followed by prose, or an object cut off part-way
+    for attempt in (candidate[:candidate.rfind("}") + 1], close_truncated_json(candidate)):
+        try:
+            data = json.loads(attempt)
+        except ValueError:
+            try:
+                data = ast.literal_eval(attempt)
+            except (ValueError, SyntaxError):
+                continue
+        if isinstance(data, dict):
+            return data, True
+    return None, False
+
+
+def normalise_feedback_key(key):
+    words = re.findall(r"[a-z]+", str(key).lower())
+    return "_".join(word for word in words if word not in _FEEDBACK_KEY_STOPWORDS)
+
+
+def coerce_feedback_score(value):
+    if isinstance(value, str):
+        match = re.search(r"\d+(?:\.\d+)?", value)
+        value = float(match.group()) if match else None
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return None
+    score = int(round(value))
+    return score if 1 <= score <= 10 else None
+
+
+def validate_feedback(data):
+    """
+    Check `data` against the feedback schema. Returns (feedback, missing): the normalised fields that
+    passed and the keys that are absent or unusable. "overall" is always recomputed from the seven
+    category scores rather than trusted from the model.
+    """
+    data = {normalise_feedback_key(key): value for key, value in data.items()}
+    feedback, missing = {}, []
+    for key in FEEDBACK_CATEGORIES:
+        entry = data.get(key)
+        score = coerce_feedback_score(entry.get("score") if isinstance(entry, dict) else entry)
+        comment = entry.get("comment") if isinstance(entry, dict) else None
+        if score is None or not isinstance(comment, str) or not comment.strip():
+            missing.append(key)
+            continue
+        feedback[key] = {"score": score, "comment": comment.strip()}
+    reasoning = data.get("clinical_reasoning")
+    if isinstance(reasoning, list):
+        reasoning = " ".join(str(item) for item in reasoning)
+    if isinstance(reasoning, str) and reasoning.strip():
+        feedback["clinical_reasoning"] = reasoning.strip()
+    else:
+        missing.append("clinical_reasoning")
+    return feedback, missing
+
+
+def complete_feedback(feedback):
+    """Add the overall score once all seven categories are present; None if any is still missing."""
+    if any(key not in feedback for key in FEEDBACK_CATEGORIES):
+        return None
+    return {key: feedback[key] for key in FEEDBACK_CATEGORIES} | {
+        "overall": sum(feedback[key]["score"] for key in FEEDBACK_CATEGORIES),
+        "clinical_reasoning": feedback.get("clinical_reasoning", ""),
+    }
+
+
+def structure_feedback(fb, user_conv_text, user_id, simulation_id):
+    """
+    Turn the model's raw feedback into a validated report dict, or None if that is not possible.
+    Fields still missing after local repair are asked for once more on their own, not the whole report.
+    """
+    data, repaired = load_feedback_json(fb)
+    if data is None:
+        feedback, missing = {}, list(FEEDBACK_CATEGORIES) + ["clinical_reasoning"]
+    else:
+        feedback, missing = validate_feedback(data)
+    if not missing:
+        record_feedback_parse("repaired" if repaired else "parsed")
+        return complete_feedback(feedback)
+    logging.warning(f"Feedback for simulation {simulation_id} missing {missing}; asking for those fields only")
+    try:
+        response = llm_client.chat(
+            "feedback_followup",
+            "gpt-4-turbo",
+            [{'role': 'system', 'content': build_feedback_followup_prompt(missing, user_conv_text)}],
+            user_id=user_id,
+            simulation_id=simulation_id,
+            temperature=0.2,
+            response_format={"type": "json_object"}
         )
-        fb = response.choices[0].message["content"]
-        logging.debug("DEBUG: Raw GPT-4 feedback:", fb)
-        if response.usage and 'prompt_tokens' in response.usage and 'completion_tokens' in response.usage:
-            current_user.token_prompt_usage_gpt4 = (current_user.token_prompt_usage_gpt4 or 0) + response.usage['prompt_tokens']
-            current_user.token_completion_usage_gpt4 = (current_user.token_completion_usage_gpt4 or 0) + response.usage['completion_tokens']
-            db.session.commit()
+        record_response_usage(user_id, "gpt-4-turbo", response)
+        extra, _ = load_feedback_json(response.choices[0].message["content"])
+        if extra is not None:
+            found, _ = validate_feedback({key: value for key, value in extra.items()
+                                          if normalise_feedback_key(key) in missing})
+            feedback.update(found)
     except Exception as e:
-        fb = f"Error generating feedback: {str(e)}"
+        logging.error(f"Feedback follow-up for simulation {simulation_id} failed: {e}")
+    result = complete_feedback(feedback)
+    record_feedback_parse("requeried" if result is not None else "failed")
+    return result
+
+
+def get_feedback_report(simulation_id=None):
+    simulation_id = simulation_id or session.get('simulation_id')
+    if not simulation_id:
+        return None
+    return db.session.get(FeedbackReport, simulation_id)
+
+
+def kick_feedback_job(simulation_id):
+    if scheduler.running:
+        run_soon(generate_feedback_report, f'feedback_{simulation_id}', simulation_id)
+    else:
+        # No scheduler in this process (e.g. a worker-role shell): grade inline
+        generate_feedback_report(simulation_id)
+
+
+def feedback_job_stale(report, now):
+    if report.status == 'pending':
+        return report.created_at < now - FEEDBACK_JOB_TIMEOUT
+    return report.status == 'running' and report.claimed_at < now - FEEDBACK_JOB_TIMEOUT
+
+
+def claim_feedback_report(simulation_id):
+    """Atomically move a pending (or abandoned running) report to running; False if someone else has it."""
+    now = datetime.utcnow()
+    claimed = db.session.execute(
+        db.update(FeedbackReport).where(
+            FeedbackReport.simulation_id == simulation_id,
+            FeedbackReport.attempts < FEEDBACK_MAX_ATTEMPTS,
+            db.or_(
+                FeedbackReport.status == 'pending',
+                db.and_(FeedbackReport.status == 'running', FeedbackReport.claimed_at < now - FEEDBACK_JOB_TIMEOUT)
+            )
+        ).values(status='running', claimed_at=now, attempts=FeedbackReport.attempts + 1)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    db.session.commit()
+    return claimed == 1
+
+
+def generate_feedback_report(simulation_id):
+    """Scheduler job: grade one simulation's transcript and store the result on its FeedbackReport."""
+    with app.app_context():
+        if not claim_feedback_report(simulation_id):
+            return
+        report = db.session.get(FeedbackReport, simulation_id)
+        user_conv_text = "\n".join(
+            [f"User: {m['content']}" for m in get_conversation(simulation_id) if m.get('role') == 'user']
+        )
+        feedback_conversation = [{'role': 'system', 'content': build_feedback_prompt(user_conv_text)}]
+        try:
+            response = llm_client.chat(
+                "feedback",
+                "gpt-4-turbo",
+                feedback_conversation,
+                user_id=report.user_id,
+                simulation_id=simulation_id,
+                temperature=0.8,
+                max_tokens=500,
+                response_format={"type": "json_object"}
+            )
+            fb = response.choices[0].message["content"]
+            logging.debug("DEBUG: Raw GPT-4 feedback:", fb)
+            record_response_usage(report.user_id, "gpt-4-turbo", response)
+            report.feedback_json = structure_feedback(fb, user_conv_text, report.user_id, simulation_id)
+        except Exception as e:
+            fb = f"Error generating feedback: {str(e)}"
+            report.feedback_json = None
+        report.feedback_raw = json.dumps(report.feedback_json, indent=2) if report.feedback_json else fb
+        report.status = 'done'
+        report.completed_at = datetime.utcnow()
+
+        # Committed before the score: record_feedback_score may roll back and retry its own
+        # transaction, which must not take the finished report (and its grading) with it
+        db.session.commit()
+        if report.feedback_json:
+            record_feedback_score(report.user_id, report.feedback_json["overall"])
+
+
+@app.route('/feedback', methods=['POST'])
+@login_required
+def feedback():
+    # Check if feedback has already been provided in this session
+    if session.get('feedback_given') or get_feedback_report():
+        flash("Feedback has already been provided in this session.", "warning")
+        return redirect(url_for('simulation'))
+
+    conversation = get_conversation()
+    if not conversation:
+        flash("No conversation available for feedback", "warning")
+        return redirect(url_for('simulation'))
+
+    simulation_id = session['simulation_id']
+    db.session.add(FeedbackReport(simulation_id=simulation_id, user_id=current_user.id))
     try:
-        feedback_json = json.loads(fb)
-        pretty_feedback = json.dumps(feedback_json, indent=2)
-        session['feedback_json'] = feedback_json
-        session['feedback'] = pretty_feedback
-        logging.debug("DEBUG: Feedback JSON parsed successfully:", pretty_feedback)
-    except Exception as e:
-        logging.debug("DEBUG: JSON parsing error in feedback:", e)
-        session['feedback_json'] = None
-        session['feedback'] = fb
-
-    # Insert new feedback record here (outside the except block)
-    if session.get('feedback_json'):
-        overall_score = session['feedback_json'].get("overall")
-        if overall_score is not None:
-            new_feedback = Feedback(user_id=current_user.id, score=overall_score)
-            db.session.add(new_feedback)
-            db.session.commit()
+        db.session.commit()
+    except IntegrityError:
+        # A double-submitted form already queued this simulation's report
+        db.session.rollback()
+    else:
+        kick_feedback_job(simulation_id)
 
     # Set flag to mark feedback as provided
     session['feedback_given'] = True
     return redirect(url_for('simulation'))
 
+
+@app.route('/feedback_status', methods=['GET'])
+@login_required
+def feedback_status():
+    report = get_feedback_report()
+    if report is None or report.user_id != current_user.id:
+        return jsonify({"status": "none"})
+    if feedback_job_stale(report, datetime.utcnow()):
+        if report.attempts < FEEDBACK_MAX_ATTEMPTS:
+            # The process running this job went away; pick it up again
+            kick_feedback_job(report.simulation_id)
+        else:
+            report.status = 'failed'
+            report.feedback_raw = "Error generating feedback: the grading job did not finish. Please try again later."
+            report.completed_at = datetime.utcnow()
+            db.session.commit()
+    return jsonify({"status": report.status})
+
+
+# --- Feedback PDF Rendering ---
+# PDFs are rendered by feedback_pdf on a small pool of OS threads, so a burst of downloads doesn't hold
+# up the other requests on a gevent worker, and cached by report content so repeat downloads skip
+# rendering entirely.
+FEEDBACK_PDF_WORKERS = int(os.getenv("FEEDBACK_PDF_WORKERS", "2"))  # 0 renders in the request itself
+FEEDBACK_PDF_RENDER_TIMEOUT = float(os.getenv("FEEDBACK_PDF_RENDER_TIMEOUT", "30"))
+FEEDBACK_PDF_CACHE_SECONDS = int(os.getenv("FEEDBACK_PDF_CACHE_SECONDS", str(24 * 3600)))
+FEEDBACK_PDF_CACHE_SIZE = int(os.getenv("FEEDBACK_PDF_CACHE_SIZE", "200"))
+
+feedback_pdf_cache = make_cache("feedback_pdf", FEEDBACK_PDF_CACHE_SECONDS, threshold=FEEDBACK_PDF_CACHE_SIZE)
+_feedback_pdf_pool = None
+_feedback_pdf_pool_lock = threading.Lock()
+
+
+def native_thread_executor(max_workers):
+    """
+    An executor whose workers are real OS threads. Under gevent workers `threading` is
+    monkey-patched, so a plain ThreadPoolExecutor would run jobs on greenlets and still block the
+    worker's event loop; gevent's own executor keeps native threads and lets the caller yield.
+    """
+    try:
+        from gevent import monkey
+    except ImportError:
+        monkey = None
+    if monkey is not None and monkey.is_module_patched("threading"):
+        from gevent.threadpool import ThreadPoolExecutor as GeventThreadPoolExecutor
+        return GeventThreadPoolExecutor(max_workers=max_workers)
+    return ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="feedback-pdf")
+
+
+def feedback_pdf_pool():
+    global _feedback_pdf_pool
+    with _feedback_pdf_pool_lock:
+        if _feedback_pdf_pool is None:
+            _feedback_pdf_pool = native_thread_executor(FEEDBACK_PDF_WORKERS)
+            atexit.register(_feedback_pdf_pool.shutdown, wait=False, cancel_futures=True)
+        return _feedback_pdf_pool
+
+
+def reset_feedback_pdf_pool():
+    global _feedback_pdf_pool
+    with _feedback_pdf_pool_lock:
+        if _feedback_pdf_pool is not None:
+            _feedback_pdf_pool.shutdown(wait=False, cancel_futures=True)
+            _feedback_pdf_pool = None
+
+
+def render_feedback_pdf(feedback_dict, raw_feedback):
+    global _feedback_pdf_pool
+    args = (feedback_dict, raw_feedback, tuple(FEEDBACK_CATEGORIES.items()))
+    if FEEDBACK_PDF_WORKERS <= 0:
+        return feedback_pdf.render(*args)
+    pool = feedback_pdf_pool()
+    try:
+        future = pool.submit(feedback_pdf.render, *args)
+    except RuntimeError as e:
+        # The pool has been shut down (e.g. by a reset in another request); the next render starts a new one
+        logging.error(f"Feedback PDF render pool unavailable ({e}); rendering in the request")
+        with _feedback_pdf_pool_lock:
+            if _feedback_pdf_pool is pool:
+                _feedback_pdf_pool = None
+        return feedback_pdf.render(*args)
+    return future.result(timeout=FEEDBACK_PDF_RENDER_TIMEOUT)
+
+
+def get_feedback_pdf(feedback_dict, raw_feedback):
+    """PDF bytes for a report, from the cache when the same content has been rendered before."""
+    content = json.dumps({"layout": feedback_pdf.LAYOUT_VERSION, "json": feedback_dict,
+                          "raw": None if feedback_dict else raw_feedback}, sort_keys=True)
+    key = "feedback_pdf:" + hashlib.sha256(content.encode("utf-8")).hexdigest()
+    pdf = feedback_pdf_cache.get(key)
+    if pdf is None:
+        pdf = render_feedback_pdf(feedback_dict, raw_feedback)
+        feedback_pdf_cache.set(key, pdf)
+    return pdf
+
+
 @app.route('/download_feedback', methods=['GET'])
 @login_required
 def download_feedback():
-    feedback_dict = session.get('feedback_json')
-    raw_feedback = session.get('feedback')
-    if not feedback_dict and not raw_feedback:
+    report = get_feedback_report()
+    if report is None or report.status not in ('done', 'failed'):
         flash("No feedback available to download", "warning")
         return redirect(url_for('simulation'))
-    import io
-    from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, ListFlowable, ListItem
-    from reportlab.lib.pagesizes import letter
-    from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-    from reportlab.lib.enums import TA_LEFT
-    from reportlab.lib import colors
-    pdf_buffer = io.BytesIO()
-    doc = SimpleDocTemplate(pdf_buffer, pagesize=letter)
-    styles = getSampleStyleSheet()
-    title_style = ParagraphStyle(
-        name='Title',
-        parent=styles['Title'],
-        fontName='Helvetica-Bold',
-        fontSize=14,
-        alignment=TA_LEFT,
-        textColor=colors.black,
-        spaceAfter=12
-    )
-    bullet_style = ParagraphStyle(
-        name='Bullet',
-        parent=styles['Normal'],
-        fontName='Helvetica',
-        fontSize=11,
-        leading=14,
-        leftIndent=20,
-        spaceBefore=4,
-        spaceAfter=4
-    )
-    story = []
-    story.append(Paragraph("Consultation Feedback", title_style))
-    story.append(Spacer(1, 8))
-    if feedback_dict:
-        bullet_items = []
-        is_score = feedback_dict["initiating_session"]["score"]
-        is_comment = feedback_dict["initiating_session"]["comment"]
-        bullet_items.append(
-            ListItem(
-                Paragraph(f"<b>Initiating the session:</b> Score: {is_score}, Comment: {is_comment}", bullet_style),
-                bulletSymbol="•"
-            )
-        )
-        gi_score = feedback_dict["gathering_information"]["score"]
-        gi_comment = feedback_dict["gathering_information"]["comment"]
-        bullet_items.append(
-            ListItem(
-                Paragraph(f"<b>Gathering information:</b> Score: {gi_score}, Comment: {gi_comment}", bullet_style),
-                bulletSymbol="•"
-            )
-        )
-        pe_score = feedback_dict["physical_examination"]["score"]
-        pe_comment = feedback_dict["physical_examination"]["comment"]
-        bullet_items.append(
-            ListItem(
-                Paragraph(f"<b>Physical examination:</b> Score: {pe_score}, Comment: {pe_comment}", bullet_style),
-                bulletSymbol="•"
-            )
-        )
-        ep_score = feedback_dict["explanation_planning"]["score"]
-        ep_comment = feedback_dict["explanation_planning"]["comment"]
-        bullet_items.append(
-            ListItem(
-                Paragraph(f"<b>Explanation &amp; planning:</b> Score: {ep_score}, Comment: {ep_comment}", bullet_style),
-                bulletSymbol="•"
-            )
-        )
-        cs_score = feedback_dict["closing_session"]["score"]
-        cs_comment = feedback_dict["closing_session"]["comment"]
-        bullet_items.append(
-            ListItem(
-                Paragraph(f"<b>Closing the session:</b> Score: {cs_score}, Comment: {cs_comment}", bullet_style),
-                bulletSymbol="•"
-            )
-        )
-        br_score = feedback_dict["building_relationship"]["score"]
-        br_comment = feedback_dict["building_relationship"]["comment"]
-        bullet_items.append(
-            ListItem(
-                Paragraph(f"<b>Building a relationship:</b> Score: {br_score}, Comment: {br_comment}", bullet_style),
-                bulletSymbol="•"
-            )
-        )
-        ps_score = feedback_dict["providing_structure"]["score"]
-        ps_comment = feedback_dict["providing_structure"]["comment"]
-        bullet_items.append(
-            ListItem(
-                Paragraph(f"<b>Providing structure:</b> Score: {ps_score}, Comment: {ps_comment}", bullet_style),
-                bulletSymbol="•"
-            )
-        )
-        overall_score = feedback_dict["overall"]
-        bullet_items.append(
-            ListItem(
-                Paragraph(f"<b>Overall Score:</b> {overall_score}/70", bullet_style),
-                bulletSymbol="•"
-            )
-        )
-        if "clinical_reasoning" in feedback_dict:
-            cr_text = feedback_dict["clinical_reasoning"]
-            bullet_items.append(
-                ListItem(
-                    Paragraph(f"<b>Clinical Reasoning &amp; Bias Analysis:</b> {cr_text}", bullet_style),
-                    bulletSymbol="•"
-                )
-            )
-        feedback_list = ListFlowable(bullet_items, bulletType='bullet', start=None)
-        story.append(feedback_list)
-    else:
-        fallback_style = ParagraphStyle(
-            name='Fallback',
-            parent=styles['Normal'],
-            fontName='Courier',
-            fontSize=10,
-            leading=12
-        )
-        story.append(Paragraph("Raw Feedback:", title_style))
-        story.append(Paragraph(raw_feedback, fallback_style))
-    doc.build(story)
-    pdf_buffer.seek(0)
+    if not report.feedback_json and not report.feedback_raw:
+        flash("No feedback available to download", "warning")
+        return redirect(url_for('simulation'))
+    try:
+        pdf = get_feedback_pdf(report.feedback_json, report.feedback_raw)
+    except FutureTimeoutError:
+        logging.error(f"Rendering the feedback PDF for simulation {report.simulation_id} timed out")
+        flash("Your feedback PDF is taking longer than expected to prepare. Please try again shortly.", "warning")
+        return redirect(url_for('simulation'))
     return send_file(
-        pdf_buffer,
+        io.BytesIO(pdf),
         as_attachment=True,
         download_name="feedback.pdf",
         mimetype="application/pdf"
@@ -1961,9 +3796,7 @@ def download_feedback():
 @app.route('/clear_simulation')
 @login_required
 def clear_simulation():
-    logging.debug("DEBUG: Clearing simulation; previous conversation:", session.get('conversation'))
-    session.pop('feedback', None)
-    session.pop('feedback_json', None)
+    logging.debug("DEBUG: Clearing simulation; previous simulation:", session.get('simulation_id'))
     session.pop('hint', None)
     session.pop('feedback_given', None)  # Clear the feedback flag here
     nomenclature = request.form.get('drug_nomenclature', 'BNF')
@@ -1984,15 +3817,15 @@ def clear_simulation():
         "If you are asked to consent to a physical examination, ALWAYS respond affirmatively with a clear 'Yes, I consent to a physical examination,' "
         "regardless of the virtual nature of the consultation."
     )
-    session['conversation'] = [{'role': 'system', 'content': instr}]
-    logging.debug("DEBUG: Simulation reinitialized with prompt:", session['conversation'])
+    start_conversation([{'role': 'system', 'content': instr}])
+    logging.debug("DEBUG: Simulation reinitialized with prompt:", instr)
     return redirect(url_for('simulation'))
 
 
 @app.route('/generate_exam', methods=['POST'])
 @login_required
 def generate_exam():
-    conversation = session.get('conversation', [])
+    conversation = get_conversation()
     user_messages = [msg for msg in conversation if msg.get('role') == 'user']
 
     if len(user_messages) < 2:
@@ -2058,21 +3891,19 @@ def generate_exam():
     logging.debug("DEBUG: Exam prompt:", exam_prompt)
 
     try:
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
-            messages=[{"role": "system", "content": exam_prompt}],
+        response = llm_client.chat(
+            "generate_exam",
+            "gpt-3.5-turbo",
+            [{"role": "system", "content": exam_prompt}],
+            user_id=current_user.id,
+            simulation_id=session.get('simulation_id'),
             temperature=0.4,
             max_tokens=250
         )
 
         exam_results = response.choices[0].message["content"].strip()
 
-        if response.usage and 'prompt_tokens' in response.usage and 'completion_tokens' in response.usage:
-            current_user.token_prompt_usage_gpt35 = (current_user.token_prompt_usage_gpt35 or 0) + response.usage[
-                'prompt_tokens']
-            current_user.token_completion_usage_gpt35 = (current_user.token_completion_usage_gpt35 or 0) + \
-                                                        response.usage['completion_tokens']
-            db.session.commit()
+        record_response_usage(current_user.id, "gpt-3.5-turbo", response)
 
     except Exception as e:
         exam_results = f"Error generating exam results: {str(e)}"
@@ -2081,90 +3912,211 @@ def generate_exam():
     return jsonify({"results": exam_results}), 200
 
 
+ALERT_NOTIFY_BATCH = int(os.getenv("ALERT_NOTIFY_BATCH", "500"))
+
+
 def notify_alert_signups():
-    MAX_SUBSCRIPTIONS = 100
+    """
+    Tell everyone on the waitlist that spaces are free. Signups are read in id-ordered pages; each
+    page's emails are added to the outbox and its signups deleted in one transaction, so a failure
+    part-way leaves every address either still waitlisted or queued, never both or neither.
+    Returns the number of notifications queued.
+    """
     active_count = User.query.filter(User.subscription_status == 'active').count()
-    free_spaces = MAX_SUBSCRIPTIONS - active_count
-    free_percentage = free_spaces / MAX_SUBSCRIPTIONS
+    free_spaces = MAX_ACTIVE_SUBSCRIPTIONS - active_count
+    free_percentage = free_spaces / MAX_ACTIVE_SUBSCRIPTIONS
+    if free_percentage < 0.15:
+        return 0
 
-    if free_percentage >= 0.15:
-        alert_signups = AlertSignup.query.all()
-        for signup in alert_signups:
-            try:
-                subject = "Subscription Space Now Available!"
-                body = (
-                    "Good news! There are now enough subscription spaces available for you to register. "
-                    "Please visit our registration page to sign up."
-                )
-                send_email_via_brevo(subject, body, signup.email)
-                logging.debug(f"Notification sent to {signup.email}")
-                db.session.delete(signup)
-            except Exception as e:
-                logging.debug(f"Error sending alert to {signup.email}: {str(e)}")
-        db.session.commit()
+    subject = "Subscription Space Now Available!"
+    body = (
+        "Good news! There are now enough subscription spaces available for you to register. "
+        "Please visit our registration page to sign up."
+    )
+    queued = 0
+    last_id = 0
+    while True:
+        page = db.session.query(AlertSignup.id, AlertSignup.email).filter(
+            AlertSignup.id > last_id
+        ).order_by(AlertSignup.id).limit(ALERT_NOTIFY_BATCH).all()
+        if not page:
+            break
+        last_id = page[-1].id
+        now = datetime.utcnow()
+        try:
+            db.session.execute(db.insert(EmailOutbox), [
+                {"to_address": row.email, "subject": subject, "body": body, "html": False, "status": 'pending',
+                 "attempts": 0, "next_attempt_at": now, "created_at": now}
+                for row in page
+            ])
+            AlertSignup.query.filter(
+                AlertSignup.id.in_([row.id for row in page])
+            ).delete(synchronize_session=False)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logging.error(f"Error queueing alert notifications after signup {last_id}: {e}")
+            raise
+        queued += len(page)
+        logging.debug(f"Queued {queued} alert notifications so far")
+    if queued:
+        kick_email_delivery()
+    return queued
+
+
+def user_cost_expression():
+    """SQL expression for a user's cumulative API cost in dollars, from their token counters."""
+    cost = 0
+    for model, (prompt_col, completion_col) in USAGE_COLUMNS.items():
+        input_cost, output_cost = MODEL_COSTS_PER_1M[model]
+        cost = cost + db.func.coalesce(getattr(User, prompt_col), 0) * input_cost \
+            + db.func.coalesce(getattr(User, completion_col), 0) * output_cost
+    return cost / 1_000_000.0
+
+
+def cost_summary(cost, condition, fractions):
+    """
+    Row count, total and continuous percentiles (as percentile_cont) of `cost` over rows matching
+    `condition`. Postgres computes all of them in a single aggregate query; SQLite (development)
+    has no percentile_cont, so there the two neighbouring values per percentile are read with
+    ORDER BY ... LIMIT 2 OFFSET n and interpolated.
+    """
+    totals = (db.func.count(), db.func.coalesce(db.func.sum(cost), 0))
+    if db.engine.dialect.name == "postgresql":
+        count, total, *percentiles = db.session.execute(db.select(
+            *totals, *[db.func.percentile_cont(fraction).within_group(cost) for fraction in fractions]
+        ).where(condition)).one()
+        return count, float(total), [float(value or 0) for value in percentiles]
+    count, total = db.session.execute(db.select(*totals).where(condition)).one()
+    if not count:
+        return 0, float(total), [0.0 for _ in fractions]
+    percentiles = []
+    for fraction in fractions:
+        position = fraction * (count - 1)
+        lower = int(position)
+        values = [float(value) for (value,) in db.session.query(cost).filter(condition)
+                  .order_by(cost).offset(lower).limit(2).all()]
+        upper_value = values[1] if len(values) > 1 else values[0]
+        percentiles.append(values[0] + (upper_value - values[0]) * (position - lower))
+    return count, float(total), percentiles
 
 
 def send_daily_update():
     with app.app_context():
         try:
-            # Get all active subscriptions regardless of category.
-            active_users = User.query.filter(User.subscription_status == 'active').all()
-            active_count = len(active_users)
-
-            weighted_costs = []
-            total_cost = 0.0
-            for user in active_users:
-                cost_gpt35 = ((user.token_prompt_usage_gpt35 or 0) / 1_000_000 * GPT35_INPUT_COST_PER_1M) + (
-                    (user.token_completion_usage_gpt35 or 0) / 1_000_000 * GPT35_OUTPUT_COST_PER_1M)
-                cost_gpt4 = ((user.token_prompt_usage_gpt4 or 0) / 1_000_000 * GPT4_INPUT_COST_PER_1M) + (
-                    (user.token_completion_usage_gpt4 or 0) / 1_000_000 * GPT4_OUTPUT_COST_PER_1M)
-                user_cost = cost_gpt35 + cost_gpt4
-                weighted_costs.append(user_cost)
-                total_cost += user_cost
-
-            median_weighted_cost = statistics.median(weighted_costs) if weighted_costs else 0.0
+            # Aggregate over all active subscriptions regardless of category, without loading the rows.
+            active_count, total_cost, (median_weighted_cost, p90_cost, p99_cost) = cost_summary(
+                user_cost_expression(), User.subscription_status == 'active', (0.5, 0.9, 0.99))
+
+            yesterday = (datetime.utcnow() - timedelta(days=1)).date()
+            route_costs = sorted((row.to_dict() for row in UsageDaily.query.filter_by(day=yesterday).all()),
+                                 key=lambda row: row["cost"], reverse=True)
+            route_lines = "".join(
+                f"{row['route']} ({row['model']}): {row['calls']} calls, ${row['cost']:.4f}\n" for row in route_costs
+            ) or "No usage recorded.\n"
 
             message = (
                 f"Daily Update:\n"
                 f"Active Subscriptions: {active_count}\n\n"
                 f"Token Cost Analysis (weighted average per subscription):\n"
                 f"Median Cost per Subscription: ${median_weighted_cost:.4f}\n"
+                f"90th Percentile Cost per Subscription: ${p90_cost:.4f}\n"
+                f"99th Percentile Cost per Subscription: ${p99_cost:.4f}\n"
                 f"Total Estimated API Cost (cumulative): ${total_cost:.4f}\n\n"
                 f"Subscription Price: $3.99/month\n\n"
                 f"Monthly API Budget: $120.00\n"
-                f"Current Headroom: ${120 - total_cost if total_cost < 120 else 0:.2f}\n"
+                f"Current Headroom: ${120 - total_cost if total_cost < 120 else 0:.2f}\n\n"
+                f"Yesterday's API Cost by Route ({yesterday}):\n"
+                f"{route_lines}"
             )
             subject = "Daily Subscription & API Cost Report"
-            send_email_via_brevo(subject, message, "simulaitor@outlook.com")
+            queue_email(subject, message, "simulaitor@outlook.com")
+            db.session.commit()
             logging.debug("Daily update email sent.")
         except Exception as e:
             logging.debug(f"Error sending daily update: {str(e)}")
 
 
+@app.route('/admin/metrics')
+@login_required
+def admin_metrics():
+    if not current_user.is_admin:
+        return jsonify({"error": "Forbidden"}), 403
+    return jsonify({
+        "llm": llm_client.snapshot(),
+        "scenario_pool": scenario_pool.snapshot(),
+        "feedback_parse": feedback_parse_snapshot(),
+        "scheduler": {"mode": SCHEDULER_MODE, "holder": scheduler_lease_holder(), "leader": is_scheduler_leader()},
+    })
+
+
+@app.route('/admin/usage')
+@login_required
+def admin_usage():
+    """Daily usage rollups for the last `days` days, most expensive route/model first."""
+    if not current_user.is_admin:
+        return jsonify({"error": "Forbidden"}), 403
+    days = request.args.get('days', 7, type=int)
+    since = (datetime.utcnow() - timedelta(days=days)).date()
+    rows = [row.to_dict() for row in UsageDaily.query.filter(UsageDaily.day >= since).all()]
+    rows.sort(key=lambda row: (row["day"], row["cost"]), reverse=True)
+    return jsonify({"days": days, "usage": rows})
+
+
 @app.route('/test_send_update')
 def test_send_update():
     send_daily_update()
     return "Test email sent. Please check your inbox."
 
 
+def record_feedback_score(user_id, score, retry=True):
+    """
+    Insert a Feedback row and fold it into the user's UserScoreStats in the same transaction.
+    Count, sum and average are incremented in SQL; the last-three average re-reads just the
+    user's three newest scores.
+    """
+    db.session.add(Feedback(user_id=user_id, score=score))
+    db.session.flush()
+    last_three = [row.score for row in db.session.query(Feedback.score).filter_by(user_id=user_id)
+                  .order_by(Feedback.created_at.desc(), Feedback.id.desc()).limit(3)]
+    last_three_avg = sum(last_three) / len(last_three)
+    updated = db.session.execute(
+        db.update(UserScoreStats).where(UserScoreStats.user_id == user_id).values(
+            feedback_count=UserScoreStats.feedback_count + 1,
+            score_sum=UserScoreStats.score_sum + score,
+            avg_score=(UserScoreStats.score_sum + score) / (UserScoreStats.feedback_count + 1),
+            last_three_avg=last_three_avg,
+            updated_at=datetime.utcnow()
+        ).execution_options(synchronize_session=False)
+    ).rowcount
+    if not updated:
+        db.session.add(UserScoreStats(user_id=user_id, feedback_count=1, score_sum=score, avg_score=score,
+                                      last_three_avg=last_three_avg))
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Another request created this user's stats row first; redo the increment against it
+        db.session.rollback()
+        if not retry:
+            raise
+        record_feedback_score(user_id, score, retry=False)
+
+
 def get_last_three_average(user_id):
-    last_three = Feedback.query.filter_by(user_id=user_id).order_by(Feedback.created_at.desc()).limit(3).all()
-    if not last_three:
-        return 0
-    avg_score = sum(f.score for f in last_three) / len(last_three)
-    return avg_score
+    stats = db.session.get(UserScoreStats, user_id)
+    return stats.last_three_avg if stats else 0
 
 
 def get_user_ranking(user_id):
-    users_avg = db.session.query(
-        Feedback.user_id,
-        db.func.avg(Feedback.score).label("avg_score")
-    ).group_by(Feedback.user_id).all()
-
-    sorted_users = sorted(users_avg, key=lambda x: x.avg_score, reverse=True)
-    ranking = next((index + 1 for index, record in enumerate(sorted_users) if record.user_id == user_id), None)
-    total_users = len(sorted_users)
-    return ranking, total_users
+    """Rank by all-time average score: one plus the number of users with a strictly higher average."""
+    total_users = db.session.query(db.func.count(UserScoreStats.user_id)).scalar()
+    stats = db.session.get(UserScoreStats, user_id)
+    if not stats:
+        return None, total_users
+    ahead = db.session.query(db.func.count(UserScoreStats.user_id)).filter(
+        UserScoreStats.avg_score > stats.avg_score
+    ).scalar()
+    return ahead + 1, total_users
 
 
 @app.route('/get_scores')
@@ -2178,20 +4130,149 @@ def get_scores():
         "total_users": total_users
     })
 
-# Initialise and start the scheduler
-scheduler = BackgroundScheduler()
+# --- Scheduler Leadership ---
+# Every web process runs a scheduler for its own in-memory work (usage buffers, scenario pool,
+# summaries). Jobs that must run once per deployment (daily email, trial conversion, usage rollup)
+# only run in the process holding the scheduler_lease row. SCHEDULER_MODE=web (default) elects that
+# process among the web workers; SCHEDULER_MODE=worker leaves them to `python -m worker`.
+SCHEDULER_MODE = os.getenv("SCHEDULER_MODE", "web")
+# Set to "worker" by worker.py; web processes don't run the leader jobs in worker mode
+PROCESS_ROLE = os.getenv("PROCESS_ROLE", "web")
+SCHEDULER_LEASE_NAME = "scheduler"
+SCHEDULER_LEASE_SECONDS = int(os.getenv("SCHEDULER_LEASE_SECONDS", "60"))
+SCHEDULER_LEASE_RENEW_SECONDS = max(SCHEDULER_LEASE_SECONDS // 3, 1)
+# Threads for interval/cron jobs, and separately for the one-off jobs queued by run_soon
+SCHEDULER_THREADS = int(os.getenv("SCHEDULER_THREADS", "10"))
+SCHEDULER_ONEOFF_THREADS = int(os.getenv("SCHEDULER_ONEOFF_THREADS", "10"))
+
+_lease_valid_until = 0.0  # time.monotonic() until which this process may act as leader
+
+
+def run_soon(job, job_id, *args):
+    """
+    Run `job(*args)` once on the scheduler's one-off threads, as soon as one is free. It is never
+    dropped for starting late (no misfire grace period), and a repeat for the same `job_id` while
+    one is still waiting is merged into it.
+    """
+    scheduler.add_job(job, args=args, id=job_id, executor='oneoff', misfire_grace_time=None, coalesce=True,
+                      replace_existing=True)
 
-# Check if the job with ID 'daily_update' exists.
-if not scheduler.get_job('daily_update'):
-    # Schedule the daily update job to run every day at 9:00 AM.
-    scheduler.add_job(send_daily_update, 'cron', id='daily_update', hour=9, minute=0)
 
-if not scheduler.get_job('trial_conversion'):
-    scheduler.add_job(convert_expired_trials, 'interval', id='trial_conversion', minutes=5)
+def scheduler_lease_holder():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
 
-# Start the scheduler
-scheduler.start()
-logging.debug("Scheduler started and daily update job scheduled.")
+def renew_scheduler_lease():
+    """Take or extend the lease; it can only be taken over once the previous holder lets it expire."""
+    global _lease_valid_until
+    holder = scheduler_lease_holder()
+    started = time.monotonic()
+    now = datetime.utcnow()
+    expires_at = now + timedelta(seconds=SCHEDULER_LEASE_SECONDS)
+    held = False
+    with app.app_context():
+        try:
+            held = db.session.execute(
+                db.update(SchedulerLease).where(
+                    SchedulerLease.name == SCHEDULER_LEASE_NAME,
+                    db.or_(SchedulerLease.holder == holder, SchedulerLease.expires_at < now)
+                ).values(holder=holder, expires_at=expires_at).execution_options(synchronize_session=False)
+            ).rowcount == 1
+            if not held and db.session.get(SchedulerLease, SCHEDULER_LEASE_NAME) is None:
+                db.session.add(SchedulerLease(name=SCHEDULER_LEASE_NAME, holder=holder, expires_at=expires_at))
+                held = True
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            held = False
+        except Exception as e:
+            db.session.rollback()
+            held = False
+            logging.error(f"Error renewing scheduler lease: {e}")
+    was_leader = is_scheduler_leader()
+    # Stop acting as leader one renewal interval before the lease could pass to another process
+    _lease_valid_until = started + SCHEDULER_LEASE_SECONDS - SCHEDULER_LEASE_RENEW_SECONDS if held else 0.0
+    if held != was_leader:
+        logging.warning(f"Scheduler leadership {'acquired' if held else 'lost'} by {holder}")
+
+
+def release_scheduler_lease():
+    global _lease_valid_until
+    if not is_scheduler_leader():
+        return
+    _lease_valid_until = 0.0
+    with app.app_context():
+        try:
+            db.session.execute(
+                db.update(SchedulerLease).where(
+                    SchedulerLease.name == SCHEDULER_LEASE_NAME,
+                    SchedulerLease.holder == scheduler_lease_holder()
+                ).values(expires_at=datetime.utcnow()).execution_options(synchronize_session=False)
+            )
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logging.error(f"Error releasing scheduler lease: {e}")
+
+
+def is_scheduler_leader():
+    return time.monotonic() < _lease_valid_until
+
+
+def leader_only(job):
+    """Wrap a scheduled job so it only runs in the process currently holding the scheduler lease."""
+    @functools.wraps(job)
+    def run_if_leader(*args, **kwargs):
+        if not is_scheduler_leader():
+            logging.debug(f"Skipping {job.__name__}: this process is not the scheduler leader")
+            return None
+        return job(*args, **kwargs)
+    return run_if_leader
+
+
+def add_leader_jobs(target):
+    """Register the once-per-deployment jobs (and the lease heartbeat) on `target`."""
+    target.add_job(renew_scheduler_lease, 'interval', id='scheduler_lease', seconds=SCHEDULER_LEASE_RENEW_SECONDS,
+                   next_run_time=datetime.now(), replace_existing=True)
+    # Schedule the daily update job to run every day at 9:00 AM.
+    target.add_job(leader_only(send_daily_update), 'cron', id='daily_update', hour=9, minute=0,
+                   replace_existing=True)
+    target.add_job(leader_only(convert_expired_trials), 'interval', id='trial_conversion',
+                   seconds=TRIAL_CONVERSION_POLL_SECONDS, replace_existing=True)
+    target.add_job(leader_only(rollup_usage_daily), 'cron', id='usage_rollup', hour=0, minute=15,
+                   replace_existing=True)
+    # Sweeps up retries and anything a kick missed; kicks from queue_email handle the common case
+    target.add_job(leader_only(deliver_email_outbox), 'interval', id='email_outbox',
+                   seconds=EMAIL_OUTBOX_POLL_SECONDS, replace_existing=True)
+    atexit.register(release_scheduler_lease)
+
+
+# Initialise and start the scheduler. One-off jobs get their own pool, so a burst of them (feedback
+# grading, summaries, email kicks) can't hold up the interval jobs or be held up by them.
+scheduler = BackgroundScheduler(executors={
+    'default': JobThreadPool(SCHEDULER_THREADS),
+    'oneoff': JobThreadPool(SCHEDULER_ONEOFF_THREADS),
+})
+
+if PROCESS_ROLE == "web":
+    if SCHEDULER_MODE == "web":
+        add_leader_jobs(scheduler)
+
+    if USAGE_FLUSH_MODE == "deferred" and not scheduler.get_job('usage_flush'):
+        scheduler.add_job(flush_token_usage, 'interval', id='usage_flush', seconds=USAGE_FLUSH_SECONDS)
+        atexit.register(flush_token_usage)
+
+    if not scheduler.get_job('usage_event_flush'):
+        scheduler.add_job(flush_usage_events, 'interval', id='usage_event_flush', seconds=USAGE_EVENT_FLUSH_SECONDS)
+        atexit.register(flush_usage_events)
+
+    if not scheduler.get_job('scenario_pool_refill'):
+        scheduler.add_job(refill_scenario_pool, 'interval', id='scenario_pool_refill',
+                          seconds=SCENARIO_POOL_REFILL_SECONDS)
+
+    # Start the scheduler
+    scheduler.start()
+    logging.debug(f"Scheduler started (SCHEDULER_MODE={SCHEDULER_MODE}).")
 
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
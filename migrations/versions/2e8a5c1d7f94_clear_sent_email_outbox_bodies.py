@@ -0,0 +1,26 @@
+"""Clear the bodies of email_outbox rows that have already been sent
+
+Revision ID: 2e8a5c1d7f94
+Revises: 9d4b7e1f3a58
+Create Date: 2025-05-15 10:04:27.551902
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2e8a5c1d7f94'
+down_revision = '9d4b7e1f3a58'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Sent and abandoned emails no longer keep their body (it holds sign-in and reset links)
+    op.execute(sa.text("UPDATE email_outbox SET body = '' WHERE status IN ('sent', 'failed')"))
+
+
+def downgrade():
+    # The cleared bodies cannot be restored
+    pass
@@ -0,0 +1,73 @@
+"""
+Benchmark: estimated prompt tokens per patient reply over a long consultation, sending the
+whole transcript (the previous behaviour) versus the managed context window.
+
+The background summariser is emulated locally (no OpenAI calls): folded turns are replaced by
+a summary capped at CONTEXT_SUMMARY_MAX_TOKENS, which is the worst case for the real summary.
+
+Usage: python scripts/bench_context_window.py [user_turns]
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from main import (CONTEXT_KEEP_TURNS, CONTEXT_SUMMARY_BATCH, CONTEXT_SUMMARY_MAX_TOKENS,  # noqa: E402
+                  compact_conversation, estimate_message_tokens, estimate_tokens)
+
+MODEL = "gpt-3.5-turbo"
+
+SYSTEM_PROMPT = (
+    "You are a patient in a history-taking simulation using the BNF drug naming standard. "
+    "Your name is John Smith (age 65) and you are a male patient. This patient has co-morbidities, "
+    "which may influence their clinical presentation based on their age and ethnicity. At the very "
+    "beginning of the consultation, your initial response is: \"Can I speak with someone about my "
+    "symptoms?\". Present your complaint: I've had a dry cough for a week. Provide only minimal details "
+    "until further questions are asked, then gradually add more information. IMPORTANT: You are a patient "
+    "and must NEVER provide any clinical advice or act as a clinician."
+)
+QUESTIONS = [
+    "Can you tell me a bit more about the cough, when did it start?",
+    "Are you bringing anything up when you cough, any phlegm or blood?",
+    "Have you noticed any shortness of breath, wheeze or chest pain with it?",
+    "Do you take any regular medicines, and have you had any allergies to medicines in the past?",
+    "Do you smoke, or have you smoked in the past, and how much alcohol do you drink in a week?",
+]
+ANSWERS = [
+    "It started about a week ago, just a tickle at first, but it's been getting a bit worse at night.",
+    "No, it's mostly dry. I haven't seen any blood, thank goodness.",
+    "I get a little puffed going up the stairs, but no real pain. Maybe a slight wheeze in the mornings.",
+    "I take ramipril for my blood pressure and a statin. I'm allergic to penicillin, it gave me a rash.",
+    "I gave up smoking about ten years ago, I used to smoke twenty a day. I have a pint or two at weekends.",
+]
+
+
+def run(user_turns):
+    messages = [{'id': 1, 'role': 'system', 'content': SYSTEM_PROMPT}]
+    next_id = 2
+    summary = None
+    summarized_through = 0
+
+    print(f"{'turn':>4}  {'full transcript':>15}  {'managed window':>14}")
+    for turn in range(1, user_turns + 1):
+        messages.append({'id': next_id, 'role': 'user', 'content': QUESTIONS[turn % len(QUESTIONS)]})
+        next_id += 1
+
+        full = estimate_message_tokens([{'role': m['role'], 'content': m['content']} for m in messages])
+        managed = estimate_message_tokens(compact_conversation(messages, summary, summarized_through, MODEL))
+        print(f"{turn:>4}  {full:>15}  {managed:>14}")
+
+        messages.append({'id': next_id, 'role': 'assistant', 'content': ANSWERS[turn % len(ANSWERS)]})
+        next_id += 1
+
+        dialogue = [m for m in messages if m['role'] != 'system' and m['id'] > summarized_through]
+        if len(dialogue) > CONTEXT_KEEP_TURNS + CONTEXT_SUMMARY_BATCH:
+            folded = dialogue[:-CONTEXT_KEEP_TURNS]
+            summary = " ".join([summary or ""] + [m['content'] for m in folded]).strip()
+            while estimate_tokens(summary) > CONTEXT_SUMMARY_MAX_TOKENS:
+                summary = summary[len(summary) // 10:]
+            summarized_through = folded[-1]['id']
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 45)
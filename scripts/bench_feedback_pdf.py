@@ -0,0 +1,111 @@
+"""
+Benchmark: time to produce the feedback PDF for /download_feedback, comparing the previous
+behaviour (ReportLab imported and styles rebuilt on every request) with prebuilt styles, a cache
+hit, and a burst of distinct downloads rendered in the request versus the render pool. The script
+runs monkey-patched by gevent, as the default gunicorn workers are, so the burst's requests are
+greenlets; "longest stall" is the worst delay seen by a greenlet that wakes every 5 ms alongside
+them: how long any other request on the worker would have been kept waiting.
+
+Uses a throwaway SQLite database and no scheduler; nothing is sent anywhere.
+
+Usage: python scripts/bench_feedback_pdf.py [renders] [burst] [workers]
+"""
+from gevent import monkey
+
+monkey.patch_all()
+
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def sample_report(i):
+    from main import FEEDBACK_CATEGORIES
+    report = {
+        key: {"score": 5 + (n + i) % 5,
+              "comment": f"Report {i}: clear and structured, though the {label.lower()} could be more thorough. " * 3}
+        for n, (key, label) in enumerate(FEEDBACK_CATEGORIES.items())
+    }
+    report["overall"] = sum(entry["score"] for entry in report.values())
+    report["clinical_reasoning"] = "Considered the likely differentials and narrowed them with targeted questions. " * 6
+    return report
+
+
+def rebuild_styles_and_render(report, categories):
+    # What every download used to pay on top of rendering: a fresh style sheet and styles
+    from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+    import feedback_pdf
+    styles = getSampleStyleSheet()
+    for name, parent in (("Title", "Title"), ("Bullet", "Normal"), ("Fallback", "Normal")):
+        ParagraphStyle(name=name, parent=styles[parent])
+    return feedback_pdf.render(report, None, categories)
+
+
+def timed(fn, runs):
+    samples = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - started) * 1000)
+    return statistics.median(samples)
+
+
+def burst(render, reports, concurrency):
+    # `concurrency` downloads in flight at once, each on its own greenlet
+    done = threading.Event()
+    stalls = []
+
+    def tick():
+        last = time.perf_counter()
+        while not done.is_set():
+            time.sleep(0.005)
+            now = time.perf_counter()
+            stalls.append(now - last - 0.005)
+            last = now
+
+    ticker = threading.Thread(target=tick)
+    ticker.start()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(lambda report: render(report, None), reports))
+    elapsed = time.perf_counter() - started
+    done.set()
+    ticker.join()
+    return elapsed, max(stalls) * 1000
+
+
+def run(renders, burst_size, workers):
+    os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "bench.db")
+    os.environ["PROCESS_ROLE"] = "worker"
+    os.environ["FEEDBACK_PDF_WORKERS"] = str(workers)
+    import feedback_pdf
+    import main
+
+    categories = tuple(main.FEEDBACK_CATEGORIES.items())
+    report = sample_report(0)
+    main.get_feedback_pdf(report, None)  # warm the cache and start the pool
+
+    print(f"{'single download':<34}{'median ms':>10}")
+    print(f"{'styles rebuilt per request':<34}{timed(lambda: rebuild_styles_and_render(report, categories), renders):>10.1f}")
+    print(f"{'prebuilt styles':<34}{timed(lambda: feedback_pdf.render(report, None, categories), renders):>10.1f}")
+    print(f"{'cache hit':<34}{timed(lambda: main.get_feedback_pdf(report, None), renders):>10.2f}")
+
+    reports = [sample_report(i) for i in range(1, burst_size + 1)]
+    print()
+    print(f"{f'burst of {burst_size} distinct downloads':<34}{'seconds':>10}{'longest stall ms':>18}")
+    for label, render in (("rendered in the request", lambda r, raw: feedback_pdf.render(r, raw, categories)),
+                          (f"render pool, {workers} workers", main.render_feedback_pdf)):
+        elapsed, stall = burst(render, reports, burst_size)
+        print(f"{label:<34}{elapsed:>10.2f}{stall:>18.1f}")
+    main.reset_feedback_pdf_pool()
+
+
+if __name__ == '__main__':
+    args = [int(arg) for arg in sys.argv[1:]]
+    run(*(args + [50, 40, os.cpu_count() or 2][len(args):]))
@@ -0,0 +1,68 @@
+"""
+Check that the hot lookup queries use their indexes: prints the database's plan for each query
+and whether the expected index appears in it.
+
+Runs against DATABASE_URL (Postgres or SQLite) after `flask db upgrade`. On Postgres, sequential
+scans are disabled for the session so that small development tables still show which index
+the planner would pick once the table is large.
+
+Usage: python scripts/check_query_plans.py
+"""
+import os
+import sys
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from main import DeviceUsage, Feedback, TrialConversion, User, UserScoreStats, app, db  # noqa: E402
+
+
+def hot_queries():
+    return [
+        ("active subscriber count", "ix_subscribers_subscription_status",
+         db.select(db.func.count(User.id)).where(User.subscription_status == 'active')),
+        ("subscribers by status", "ix_subscribers_subscription_status",
+         db.select(User.email).where(User.subscription_status == 'cancelled')),
+        ("last three feedback scores", "ix_feedback_user_id_created_at",
+         db.select(Feedback.score).where(Feedback.user_id == 1).order_by(Feedback.created_at.desc()).limit(3)),
+        ("devices for user", "ix_device_usage_user_id",
+         db.select(DeviceUsage).where(DeviceUsage.user_id == 1)),
+        ("due trial conversions", "ix_trial_conversion_status_due_at",
+         db.select(TrialConversion).where(TrialConversion.status == 'pending',
+                                          TrialConversion.due_at <= datetime.utcnow())
+         .order_by(TrialConversion.due_at).limit(50)),
+        ("leaderboard rank", "ix_user_score_stats_avg_score",
+         db.select(db.func.count(UserScoreStats.user_id)).where(UserScoreStats.avg_score > 50)),
+    ]
+
+
+def explain(connection, statement):
+    compiled = statement.compile(dialect=connection.dialect)
+    if connection.dialect.name == "postgresql":
+        prefix = "EXPLAIN"
+    else:
+        prefix = "EXPLAIN QUERY PLAN"
+    if compiled.positional:
+        params = tuple(compiled.params[name] for name in compiled.positiontup)
+    else:
+        params = compiled.params
+    rows = connection.exec_driver_sql(f"{prefix} {compiled}", params).fetchall()
+    return "\n".join(str(row[-1]) for row in rows)
+
+
+def main():
+    missing = 0
+    with app.app_context(), db.engine.connect() as connection:
+        if connection.dialect.name == "postgresql":
+            connection.exec_driver_sql("SET enable_seqscan = off")
+        for name, index, statement in hot_queries():
+            plan = explain(connection, statement)
+            used = index in plan
+            missing += not used
+            print(f"{'OK  ' if used else 'MISS'} {name} (expects {index})")
+            print("     " + plan.replace("\n", "\n     "))
+    sys.exit(1 if missing else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+"""
+Local SMTP sink: accepts every message (and any AUTH), counts it and throws it away. Use it to
+run the app without sending real email, or to benchmark delivery.
+
+Run a sink for the app (then start the app with SMTP_HOST=localhost SMTP_PORT=2525 SMTP_STARTTLS=false):
+    python scripts/smtp_sink.py [--port 2525] [--delay-ms 0] [--connect-delay-ms 0]
+
+Benchmark one connection per message (send_email_via_brevo) against the outbox sender on one and
+on --connections parallel connections, using a throwaway SQLite database. --connect-delay-ms stands
+in for the TLS handshake and login of a real relay, --delay-ms for its per-message latency:
+    python scripts/smtp_sink.py --bench 500 --connect-delay-ms 150 --delay-ms 5 --connections 4
+"""
+import argparse
+import os
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class SinkServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, delay, connect_delay, quiet=False):
+        super().__init__(address, SinkHandler)
+        self.delay = delay
+        self.connect_delay = connect_delay
+        self.quiet = quiet
+        self.lock = threading.Lock()
+        self.messages = 0
+        self.connections = 0
+
+    def count(self, field):
+        with self.lock:
+            setattr(self, field, getattr(self, field) + 1)
+
+
+class SinkHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(line.encode() + b"\r\n")
+
+    def handle(self):
+        self.server.count("connections")
+        time.sleep(self.server.connect_delay)
+        self.reply("220 smtp-sink ready")
+        in_data = False
+        for raw in self.rfile:
+            line = raw.decode("utf-8", "replace").rstrip("\r\n")
+            if in_data:
+                if line == ".":
+                    in_data = False
+                    time.sleep(self.server.delay)
+                    self.server.count("messages")
+                    if not self.server.quiet:
+                        print(f"message {self.server.messages} received")
+                    self.reply("250 2.0.0 Ok: queued")
+                continue
+            command = line.split(" ", 1)[0].upper()
+            if command == "EHLO":
+                self.wfile.write(b"250-smtp-sink\r\n250-AUTH PLAIN LOGIN\r\n250 8BITMIME\r\n")
+            elif command == "AUTH":
+                self.reply("235 2.7.0 Authentication successful")
+            elif command in ("HELO", "MAIL", "RCPT", "RSET", "NOOP"):
+                self.reply("250 2.0.0 Ok")
+            elif command == "DATA":
+                in_data = True
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+            elif command == "QUIT":
+                self.reply("221 2.0.0 Bye")
+                return
+            else:
+                self.reply("502 5.5.2 Command not recognised")
+
+
+def start_sink(port, delay_ms, connect_delay_ms, quiet=False):
+    server = SinkServer(("127.0.0.1", port), delay_ms / 1000, connect_delay_ms / 1000, quiet)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def queue_bench_emails(main, count):
+    with main.app.app_context():
+        main.db.session.add_all([
+            main.EmailOutbox(to_address=f"user{i}@example.com", subject="Benchmark", body=f"Message {i}",
+                             html=False, status='pending', attempts=0, next_attempt_at=main.datetime.utcnow())
+            for i in range(count)
+        ])
+        main.db.session.commit()
+
+
+def bench(count, delay_ms, connect_delay_ms, connections):
+    # Throwaway database, and no scheduler in this process: delivery is driven directly below
+    os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "bench.db")
+    os.environ["PROCESS_ROLE"] = "worker"
+    import main
+
+    sink = start_sink(0, delay_ms, connect_delay_ms, quiet=True)
+    main.SMTP_HOST, main.SMTP_PORT = sink.server_address
+    main.SMTP_STARTTLS = False
+    with main.app.app_context():
+        main.db.create_all()
+
+    started = time.perf_counter()
+    for i in range(count):
+        main.send_email_via_brevo("Benchmark", f"Message {i}", f"user{i}@example.com")
+    direct = time.perf_counter() - started
+    direct_connections = sink.connections
+
+    print(f"{'mode':<28}{'seconds':>10}{'msg/s':>10}{'connections':>13}")
+    print(f"{'connection per message':<28}{direct:>10.2f}{count / direct:>10.0f}{direct_connections:>13}")
+    for parallel in sorted({1, connections}):
+        main.EMAIL_SENDER_CONNECTIONS = parallel
+        queue_bench_emails(main, count)
+        opened = sink.connections
+        started = time.perf_counter()
+        main.deliver_email_outbox()
+        elapsed = time.perf_counter() - started
+        label = f"outbox, {parallel} connection{'s' if parallel > 1 else ''}"
+        print(f"{label:<28}{elapsed:>10.2f}{count / elapsed:>10.0f}{sink.connections - opened:>13}")
+    with main.app.app_context():
+        unsent = main.EmailOutbox.query.filter(main.EmailOutbox.status != 'sent').count()
+    if unsent:
+        print(f"{unsent} messages were not sent")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--port", type=int, default=2525)
+    parser.add_argument("--delay-ms", type=float, default=0, help="per-message processing delay")
+    parser.add_argument("--connect-delay-ms", type=float, default=0, help="per-connection setup delay")
+    parser.add_argument("--bench", type=int, metavar="N", help="benchmark delivering N messages and exit")
+    parser.add_argument("--connections", type=int, default=4, help="parallel connections for --bench")
+    args = parser.parse_args()
+    if args.bench:
+        bench(args.bench, args.delay_ms, args.connect_delay_ms, args.connections)
+        return
+    server = SinkServer(("127.0.0.1", args.port), args.delay_ms / 1000, args.connect_delay_ms / 1000)
+    print(f"SMTP sink listening on 127.0.0.1:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(f"\n{server.messages} messages over {server.connections} connections")
+
+
+if __name__ == '__main__':
+    main()
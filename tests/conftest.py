@@ -0,0 +1,63 @@
+import logging
+import os
+import sys
+import tempfile
+
+import pytest
+
+# main.py reads its configuration at import time, so point it at a throwaway SQLite database and
+# keep the scheduler out of the test process. The working directory moves too, because app.log and
+# the filesystem session store are created relative to it.
+_workdir = tempfile.mkdtemp(prefix="app-tests-")
+os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(_workdir, "test.db")
+os.environ["SECRET_KEY"] = "test-secret"
+os.environ["PROCESS_ROLE"] = "worker"
+os.chdir(_workdir)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+from openai.openai_object import OpenAIObject  # noqa: E402
+
+# Several debug calls pass print-style extra arguments, which pytest's log capture reports as errors
+logging.getLogger().setLevel(logging.WARNING)
+
+
+@pytest.fixture
+def app():
+    with main.app.app_context():
+        main.db.create_all()
+    yield main.app
+    with main.app.app_context():
+        main.db.session.remove()
+        main.db.drop_all()
+    main.subscriber_cache.clear()
+    main.identity_cache.clear()
+
+
+@pytest.fixture
+def make_user(app):
+    def make_user(email, **fields):
+        with app.app_context():
+            user = main.User(**{"email": email, "password": "x", "current_session": f"token-{email}",
+                                "subscription_status": "active", **fields})
+            main.db.session.add(user)
+            main.db.session.commit()
+            return user.id
+    return make_user
+
+
+def login(client, user_id, **session_values):
+    with main.app.app_context():
+        token = main.db.session.get(main.User, user_id).current_session
+    with client.session_transaction() as sess:
+        sess["_user_id"] = str(user_id)
+        sess["_fresh"] = True
+        sess["session_token"] = token
+        sess.update(session_values)
+
+
+def chat_response(content, prompt_tokens, completion_tokens):
+    return OpenAIObject.construct_from({
+        "choices": [{"message": {"role": "assistant", "content": content}}],
+        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens},
+    })
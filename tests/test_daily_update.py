@@ -0,0 +1,59 @@
+import statistics
+
+import pytest
+from sqlalchemy.dialects import postgresql
+
+import main
+
+FRACTIONS = (0.5, 0.9, 0.99)
+
+
+@pytest.fixture
+def subscribers(app, make_user):
+    # Active subscribers with costs of $0.01 to $0.07, in prompt tokens of the first model
+    prompt_col = next(iter(main.USAGE_COLUMNS.values()))[0]
+    input_cost = main.MODEL_COSTS_PER_1M[next(iter(main.USAGE_COLUMNS))][0]
+    costs = [n / 100 for n in range(1, 8)]
+    for n, cost in enumerate(costs):
+        make_user(f"active{n}@example.com", **{prompt_col: round(cost * 1_000_000 / input_cost)})
+    make_user("lapsed@example.com", subscription_status="canceled", **{prompt_col: 10 ** 9})
+    return costs
+
+
+def test_sqlite_summary_matches_percentile_cont(app, subscribers):
+    with app.app_context():
+        count, total, percentiles = main.cost_summary(main.user_cost_expression(),
+                                                      main.User.subscription_status == 'active', FRACTIONS)
+
+    expected = statistics.quantiles(subscribers, n=100, method="inclusive")
+    assert count == len(subscribers)
+    assert total == pytest.approx(sum(subscribers))
+    assert percentiles == pytest.approx([expected[49], expected[89], expected[98]])
+
+
+def test_no_matching_rows(app):
+    with app.app_context():
+        assert main.cost_summary(main.user_cost_expression(), main.User.subscription_status == 'active',
+                                 FRACTIONS) == (0, 0.0, [0.0, 0.0, 0.0])
+
+
+def test_postgres_summary_is_a_single_query(app, monkeypatch):
+    statements = []
+
+    class Result:
+        def one(self):
+            return 3, 0.5, 0.1, 0.2, 0.3
+
+    def execute(statement, *args, **kwargs):
+        statements.append(str(statement.compile(dialect=postgresql.dialect())))
+        return Result()
+
+    with app.app_context():
+        monkeypatch.setattr(main.db.engine.dialect, "name", "postgresql")
+        monkeypatch.setattr(main.db.session, "execute", execute)
+        summary = main.cost_summary(main.user_cost_expression(), main.User.subscription_status == 'active',
+                                    FRACTIONS)
+
+    assert summary == (3, 0.5, [0.1, 0.2, 0.3])
+    (sql,) = statements
+    assert sql.count("percentile_cont(") == 3 and "count(*)" in sql and "sum(" in sql
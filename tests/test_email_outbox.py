@@ -0,0 +1,73 @@
+import pytest
+
+import main
+
+
+@pytest.fixture
+def kicks(monkeypatch):
+    kicks = []
+    monkeypatch.setattr(main, "kick_email_delivery", lambda: kicks.append(1))
+    return kicks
+
+
+class FakeSender:
+    def __init__(self):
+        self.sent = []
+
+    def send(self, msg):
+        self.sent.append(msg)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+def outbox():
+    return main.EmailOutbox.query.order_by(main.EmailOutbox.id).all()
+
+
+def test_queued_email_is_part_of_the_callers_transaction(app, kicks):
+    with app.app_context():
+        main.queue_email("Dropped", "never sent", "a@example.com")
+        main.db.session.rollback()
+        assert outbox() == [] and kicks == []
+
+        main.queue_email("Kept", "sent", "a@example.com")
+        assert kicks == []  # nothing is delivered before the caller commits
+        main.db.session.commit()
+        assert [email.subject for email in outbox()] == ["Kept"]
+        assert kicks == [1]
+
+
+def test_forgot_password_queues_the_reset_email_and_commits(app, make_user, kicks):
+    make_user("reset@example.com")
+
+    response = app.test_client().post("/forgot_password", data={"email": "reset@example.com"})
+
+    assert response.status_code == 302
+    with app.app_context():
+        (email,) = outbox()
+        assert email.subject == "Password Reset Request" and "/reset_password/" in email.body
+    assert kicks == [1]
+
+
+def test_sent_email_body_is_cleared(app, kicks, monkeypatch):
+    sender = FakeSender()
+    monkeypatch.setattr(main, "SMTPSender", lambda: sender)
+    monkeypatch.setattr(main, "EMAIL_SENDER_CONNECTIONS", 1)
+    with app.app_context():
+        main.queue_email("Password Reset Request", "<a href='https://example.com/reset/abc'>Reset</a>",
+                         "a@example.com", html=True)
+        main.db.session.commit()
+
+    main.deliver_email_outbox()
+
+    assert [msg["Subject"] for msg in sender.sent] == ["Password Reset Request"]
+    with app.app_context():
+        (email,) = outbox()
+        assert (email.status, email.body, email.subject) == ("sent", "", "Password Reset Request")
@@ -0,0 +1,90 @@
+import json
+import threading
+import time
+
+import pytest
+from apscheduler.schedulers.background import BackgroundScheduler
+from sqlalchemy import event
+
+import main
+from conftest import chat_response
+
+
+def test_one_off_jobs_wait_for_a_free_thread_instead_of_being_dropped(monkeypatch):
+    scheduler = BackgroundScheduler(executors={'oneoff': main.JobThreadPool(2)})
+    monkeypatch.setattr(main, "scheduler", scheduler)
+    finished = []
+    lock = threading.Lock()
+
+    def slow_job(name):
+        time.sleep(1.2)  # longer than APScheduler's default one-second misfire grace period
+        with lock:
+            finished.append(name)
+
+    scheduler.start()
+    try:
+        for name in ("a", "b", "c", "d"):
+            main.run_soon(slow_job, f"job-{name}", name)
+        deadline = time.monotonic() + 10
+        while len(finished) < 4 and time.monotonic() < deadline:
+            time.sleep(0.05)
+    finally:
+        scheduler.shutdown(wait=False)
+    assert sorted(finished) == ["a", "b", "c", "d"]
+
+
+@pytest.fixture
+def pending_report(app, make_user):
+    user_id = make_user("student@example.com")
+    with app.app_context():
+        main.db.session.add(main.Simulation(id="sim-1", user_id=user_id))
+        main.db.session.add(main.ConversationTurn(simulation_id="sim-1", role="user", content="Any allergies?"))
+        main.db.session.add(main.FeedbackReport(simulation_id="sim-1", user_id=user_id))
+        main.db.session.commit()
+    # An earlier consultation already gave this user a stats row
+    with app.app_context():
+        main.record_feedback_score(user_id, 40)
+    return user_id
+
+
+def test_score_insert_race_does_not_discard_the_graded_report(app, pending_report, monkeypatch):
+    feedback = {key: {"score": 7, "comment": "Good."} for key in main.FEEDBACK_CATEGORIES}
+    feedback["clinical_reasoning"] = "Sound."
+    grading_calls = []
+
+    def fake_chat(route, model, messages, **kwargs):
+        grading_calls.append(route)
+        return chat_response(json.dumps(feedback), 900, 400)
+
+    monkeypatch.setattr(main.llm_client, "chat", fake_chat)
+
+    # Make the stats UPDATE miss once, as if the row were created by another request just after it
+    # ran: the INSERT that follows then fails and record_feedback_score rolls back and retries
+    raced = []
+
+    def miss_first_stats_update(conn, cursor, statement, parameters, context, executemany):
+        if statement.startswith("UPDATE user_score_stats") and not raced:
+            raced.append(statement)
+            statement += " AND 1 = 0"
+        return statement, parameters
+
+    with app.app_context():
+        event.listen(main.db.engine, "before_cursor_execute", miss_first_stats_update, retval=True)
+    try:
+        main.generate_feedback_report("sim-1")
+    finally:
+        with app.app_context():
+            event.remove(main.db.engine, "before_cursor_execute", miss_first_stats_update)
+
+    assert raced and grading_calls == ["feedback"]
+    with app.app_context():
+        report = main.db.session.get(main.FeedbackReport, "sim-1")
+        assert report.status == "done"
+        assert report.feedback_json["overall"] == 49
+        scores = [row.score for row in main.Feedback.query.filter_by(user_id=pending_report)]
+        assert sorted(scores) == [40, 49]
+        stats = main.db.session.get(main.UserScoreStats, pending_report)
+        assert (stats.feedback_count, stats.score_sum) == (2, 89)
+    # A second run finds the report finished and grades nothing
+    main.generate_feedback_report("sim-1")
+    assert grading_calls == ["feedback"]
@@ -0,0 +1,80 @@
+import json
+import os
+import subprocess
+import sys
+import textwrap
+
+import pytest
+
+import main
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+REPORT = {key: {"score": 6, "comment": "Clear."} for key in main.FEEDBACK_CATEGORIES}
+REPORT["overall"] = 6 * len(main.FEEDBACK_CATEGORIES)
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    monkeypatch.setattr(main, "FEEDBACK_PDF_WORKERS", 2)
+    main.reset_feedback_pdf_pool()
+    yield
+    main.reset_feedback_pdf_pool()
+
+
+def test_renders_on_the_pool(pool):
+    assert main.render_feedback_pdf(REPORT, None).startswith(b"%PDF")
+    assert main._feedback_pdf_pool is not None
+
+
+def test_shut_down_pool_falls_back_to_rendering_in_the_request_and_is_replaced(pool):
+    broken = main.feedback_pdf_pool()
+    broken.shutdown(wait=True)
+
+    assert main.render_feedback_pdf(REPORT, None).startswith(b"%PDF")
+    assert main._feedback_pdf_pool is None
+
+    assert main.render_feedback_pdf(REPORT, None).startswith(b"%PDF")
+    assert main._feedback_pdf_pool not in (None, broken)
+
+
+GEVENT_SCRIPT = textwrap.dedent("""
+    from gevent import monkey
+    monkey.patch_all()
+
+    import json
+    import gevent
+    import feedback_pdf
+    import main
+
+    get_native_ident = monkey.get_original("_thread", "get_ident")
+    request_thread = get_native_ident()
+    render_threads = set()
+    render = feedback_pdf.render
+
+    def tracked_render(*args):
+        render_threads.add(get_native_ident())
+        return render(*args)
+
+    feedback_pdf.render = tracked_render
+    report = {key: {"score": 6, "comment": f"Report {i}"} for i, key in enumerate(main.FEEDBACK_CATEGORIES)}
+    report["overall"] = 42
+    downloads = [gevent.spawn(main.render_feedback_pdf, dict(report, overall=n), None) for n in range(6)]
+    gevent.joinall(downloads, raise_error=True)
+    print(json.dumps({
+        "executor": type(main.feedback_pdf_pool()).__module__,
+        "pdfs": all(download.value.startswith(b"%PDF") for download in downloads),
+        "rendered_off_the_event_loop": bool(render_threads) and request_thread not in render_threads,
+    }))
+""")
+
+
+def test_pool_uses_native_threads_under_gevent(tmp_path):
+    env = dict(os.environ, DATABASE_URL=f"sqlite:///{tmp_path}/gevent.db", SECRET_KEY="test-secret",
+               PROCESS_ROLE="worker", FEEDBACK_PDF_WORKERS="2", PYTHONPATH=REPO)
+    result = subprocess.run([sys.executable, "-c", GEVENT_SCRIPT], cwd=tmp_path, env=env, capture_output=True,
+                            text=True, timeout=120)
+
+    assert result.returncode == 0, result.stderr
+    assert json.loads(result.stdout.strip().splitlines()[-1]) == {
+        "executor": "gevent.threadpool", "pdfs": True, "rendered_off_the_event_loop": True,
+    }
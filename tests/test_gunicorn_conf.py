@@ -0,0 +1,42 @@
+import logging
+import os
+import runpy
+from types import SimpleNamespace
+
+import pytest
+
+CONF = runpy.run_path(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "gunicorn.conf.py"))
+
+
+def server(workers, preload_app=False):
+    return SimpleNamespace(cfg=SimpleNamespace(workers=workers, preload_app=preload_app),
+                           log=logging.getLogger("gunicorn.test"))
+
+
+@pytest.fixture(autouse=True)
+def cache_backend(monkeypatch):
+    monkeypatch.delenv("CACHE_BACKEND", raising=False)
+
+
+def test_single_worker_keeps_the_per_process_cache():
+    CONF["on_starting"](server(1))
+    assert "CACHE_BACKEND" not in os.environ
+
+
+def test_several_workers_share_the_filesystem_cache():
+    CONF["on_starting"](server(4))
+    assert os.environ["CACHE_BACKEND"] == "filesystem"
+
+
+def test_explicitly_shared_backend_is_left_alone(monkeypatch):
+    monkeypatch.setenv("CACHE_BACKEND", "filesystem")
+    CONF["on_starting"](server(4))
+    assert os.environ["CACHE_BACKEND"] == "filesystem"
+
+
+@pytest.mark.parametrize("backend, preload_app", [("simple", False), (None, True)])
+def test_per_process_cache_with_several_workers_refuses_to_start(monkeypatch, backend, preload_app):
+    if backend:
+        monkeypatch.setenv("CACHE_BACKEND", backend)
+    with pytest.raises(RuntimeError, match="CACHE_BACKEND=filesystem"):
+        CONF["on_starting"](server(4, preload_app))
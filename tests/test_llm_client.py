@@ -0,0 +1,106 @@
+import openai
+import pytest
+
+import main
+from conftest import chat_response
+
+THRESHOLD = 3
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(main, "LLM_MAX_RETRIES", 0)
+    client = main.LLMClient()
+    client.breaker = main.CircuitBreaker(THRESHOLD, cooldown_seconds=0, slow_call_seconds=60)
+    return client
+
+
+@pytest.fixture
+def openai_returns(monkeypatch):
+    outcomes = []
+
+    def create(**kwargs):
+        outcome = outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    monkeypatch.setattr(openai.ChatCompletion, "create", create)
+    return outcomes
+
+
+def call(client, **kwargs):
+    try:
+        return client.chat("get_reply", "gpt-3.5-turbo", [{"role": "user", "content": "Hi"}], **kwargs)
+    except openai.error.OpenAIError as e:
+        return e
+
+
+def half_open(client, openai_returns):
+    openai_returns.extend([openai.error.APIError("bad gateway", http_status=502)] * THRESHOLD)
+    for _ in range(THRESHOLD):
+        call(client)
+    assert client.breaker.state == main.CircuitBreaker.OPEN
+    client.breaker.before_call()  # cooldown is zero: the next call is the recovery probe
+    client.breaker.release_probe()
+    assert client.breaker.state == main.CircuitBreaker.HALF_OPEN
+
+
+def stream_of(*parts):
+    return iter([openai.openai_object.OpenAIObject.construct_from(
+        {"choices": [{"delta": {"content": part}}]}) for part in parts])
+
+
+def test_bad_request_does_not_close_a_half_open_breaker(client, openai_returns):
+    half_open(client, openai_returns)
+    openai_returns.append(openai.error.InvalidRequestError("bad parameter", "messages", http_status=400))
+
+    assert isinstance(call(client), openai.error.InvalidRequestError)
+
+    assert client.breaker.state == main.CircuitBreaker.HALF_OPEN
+    openai_returns.append(chat_response("Hello", 5, 1))
+    call(client)  # the probe slot was released, so a real call still gets through
+    assert client.breaker.state == main.CircuitBreaker.CLOSED
+
+
+def test_bad_requests_do_not_reset_the_failure_count(client, openai_returns):
+    openai_returns.extend([openai.error.APIError("bad gateway", http_status=502),
+                           openai.error.InvalidRequestError("bad parameter", "messages", http_status=400),
+                           openai.error.APIError("bad gateway", http_status=502),
+                           openai.error.APIError("bad gateway", http_status=502)])
+    for _ in range(4):
+        call(client)
+    assert client.breaker.state == main.CircuitBreaker.OPEN
+
+
+def test_authentication_errors_trip_the_breaker(client, openai_returns):
+    openai_returns.extend([openai.error.AuthenticationError("invalid key", http_status=401)] * THRESHOLD)
+    for _ in range(THRESHOLD):
+        assert isinstance(call(client), openai.error.AuthenticationError)
+    assert client.breaker.state == main.CircuitBreaker.OPEN
+
+
+def test_stream_counts_as_a_success_only_once_it_is_read_to_the_end(client, openai_returns):
+    half_open(client, openai_returns)
+    openai_returns.append(stream_of("About ", "a week."))
+
+    stream = call(client, stream=True)
+    assert next(stream).choices[0].delta["content"] == "About "
+    assert client.breaker.state == main.CircuitBreaker.HALF_OPEN
+    list(stream)
+
+    assert client.breaker.state == main.CircuitBreaker.CLOSED
+
+
+def test_stream_that_breaks_off_reopens_a_half_open_breaker(client, openai_returns):
+    half_open(client, openai_returns)
+
+    def broken_stream():
+        yield from stream_of("About ")
+        raise openai.error.APIConnectionError("connection reset")
+
+    openai_returns.append(broken_stream())
+
+    with pytest.raises(openai.error.APIConnectionError):
+        list(call(client, stream=True))
+    assert client.breaker.state == main.CircuitBreaker.OPEN
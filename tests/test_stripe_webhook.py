@@ -0,0 +1,55 @@
+import hashlib
+import hmac
+import json
+import time
+
+import pytest
+
+import main
+
+SECRET = "whsec_test"
+EVENT = json.dumps({"id": "evt_1", "object": "event", "type": "invoice.created", "created": 1,
+                    "data": {"object": {"id": "in_1", "object": "invoice"}}})
+
+
+def signed(payload, secret=SECRET):
+    timestamp = int(time.time())
+    digest = hmac.new(secret.encode(), f"{timestamp}.{payload}".encode(), hashlib.sha256).hexdigest()
+    return {"Stripe-Signature": f"t={timestamp},v1={digest}"}
+
+
+def post(app, payload, headers):
+    return app.test_client().post("/stripe/webhook", data=payload, headers=headers,
+                                  content_type="application/json")
+
+
+def test_unconfigured_secret_rejects_every_event(app, monkeypatch):
+    monkeypatch.setattr(main, "STRIPE_WEBHOOK_SECRET", None)
+
+    response = post(app, EVENT, signed(EVENT))
+
+    assert response.status_code == 503
+    assert response.get_json() == {"error": "Webhook not configured"}
+
+
+@pytest.mark.parametrize("payload, headers, error", [
+    (EVENT, signed(EVENT, "whsec_other"), "Invalid signature"),
+    (EVENT, {}, "Invalid signature"),
+    ("not json", signed("not json"), "Invalid payload"),
+])
+def test_bad_deliveries_are_rejected(app, monkeypatch, payload, headers, error):
+    monkeypatch.setattr(main, "STRIPE_WEBHOOK_SECRET", SECRET)
+
+    response = post(app, payload, headers)
+
+    assert response.status_code == 400
+    assert response.get_json() == {"error": error}
+
+
+def test_signed_event_is_accepted(app, monkeypatch):
+    monkeypatch.setattr(main, "STRIPE_WEBHOOK_SECRET", SECRET)
+
+    response = post(app, EVENT, signed(EVENT))
+
+    assert response.status_code == 200
+    assert response.get_json() == {"received": True}
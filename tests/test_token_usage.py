@@ -0,0 +1,104 @@
+import threading
+import time
+
+import pytest
+
+import main
+from conftest import chat_response, login
+
+THREADS = 8
+CALLS_PER_THREAD = 25
+
+
+def run_in_threads(target, count):
+    errors = []
+    start = threading.Barrier(count)
+
+    def run(index):
+        try:
+            start.wait()
+            target(index)
+        except Exception as e:  # surfaced below so a failed thread fails the test
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(index,)) for index in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors, errors
+
+
+def token_totals(user_id):
+    with main.app.app_context():
+        user = main.db.session.get(main.User, user_id)
+        return (user.token_prompt_usage_gpt35 or 0, user.token_completion_usage_gpt35 or 0,
+                user.token_prompt_usage_gpt4 or 0, user.token_completion_usage_gpt4 or 0)
+
+
+def test_apply_token_usage_keeps_every_concurrent_increment(make_user):
+    user_id = make_user("usage@example.com")
+
+    def add_usage(_):
+        for _ in range(CALLS_PER_THREAD):
+            with main.app.app_context():
+                main.apply_token_usage(user_id, {"token_prompt_usage_gpt35": 3, "token_completion_usage_gpt35": 2})
+
+    run_in_threads(add_usage, THREADS)
+
+    calls = THREADS * CALLS_PER_THREAD
+    assert token_totals(user_id) == (3 * calls, 2 * calls, 0, 0)
+
+
+def test_deferred_usage_is_flushed_exactly_once(make_user, monkeypatch):
+    monkeypatch.setattr(main, "USAGE_FLUSH_MODE", "deferred")
+    first = make_user("first@example.com")
+    second = make_user("second@example.com")
+
+    def record(index):
+        user_id = first if index % 2 else second
+        for _ in range(CALLS_PER_THREAD):
+            main.record_token_usage(user_id, "gpt-4-turbo", 10, 4)
+
+    run_in_threads(record, THREADS)
+    assert token_totals(first) == (0, 0, 0, 0)
+    main.flush_token_usage()
+    main.flush_token_usage()  # nothing left to apply a second time
+
+    per_user = THREADS // 2 * CALLS_PER_THREAD
+    assert token_totals(first) == (0, 0, 10 * per_user, 4 * per_user)
+    assert token_totals(second) == (0, 0, 10 * per_user, 4 * per_user)
+
+
+@pytest.mark.parametrize("flush_mode", ["inline", "deferred"])
+def test_parallel_get_reply_counts_every_call(app, make_user, monkeypatch, flush_mode):
+    monkeypatch.setattr(main, "USAGE_FLUSH_MODE", flush_mode)
+    users = [make_user("alice@example.com"), make_user("bob@example.com")]
+    with app.app_context():
+        for user_id in users:
+            main.db.session.add(main.Simulation(id=f"sim-{user_id}", user_id=user_id))
+            main.db.session.add(main.ConversationTurn(simulation_id=f"sim-{user_id}", role="user",
+                                                      content="How long have you had the cough?"))
+        main.db.session.commit()
+
+    def fake_chat(route, model, messages, **kwargs):
+        time.sleep(0.005)  # hold the call open so requests overlap
+        return chat_response("About a week now.", 17, 5)
+
+    monkeypatch.setattr(main.llm_client, "chat", fake_chat)
+
+    def send_replies(index):
+        user_id = users[index % len(users)]
+        client = app.test_client()
+        login(client, user_id, simulation_id=f"sim-{user_id}")
+        for _ in range(CALLS_PER_THREAD):
+            response = client.post("/get_reply")
+            assert response.status_code == 200
+            assert response.get_json()["fallback"] is False
+
+    run_in_threads(send_replies, THREADS)
+    main.flush_token_usage()
+
+    per_user = THREADS // len(users) * CALLS_PER_THREAD
+    for user_id in users:
+        assert token_totals(user_id) == (17 * per_user, 5 * per_user, 0, 0)
@@ -0,0 +1,93 @@
+from datetime import datetime, timedelta
+
+import pytest
+import stripe
+
+import main
+
+
+@pytest.fixture
+def conversion_id(app, make_user):
+    user_id = make_user("trial@example.com", stripe_customer_id="cus_1", stored_payment_method_id="pm_1",
+                        promo_code="WELCOME")
+    with app.app_context():
+        user = main.db.session.get(main.User, user_id)
+        user.subscription_status = "trial"
+        user.trial_start = datetime.utcnow() - main.TRIAL_PERIOD - timedelta(minutes=1)
+        conversion = main.schedule_trial_conversion(user)
+        main.db.session.commit()
+        return conversion.id
+
+
+@pytest.fixture
+def stripe_calls(monkeypatch):
+    calls = {"create": [], "promo_lookups": 0, "failures": []}
+
+    def list_promotion_codes(**kwargs):
+        calls["promo_lookups"] += 1
+        return stripe.util.convert_to_stripe_object({"object": "list", "data": [{"id": "promo_1"}]})
+
+    def create_subscription(**kwargs):
+        calls["create"].append(kwargs)
+        if calls["failures"]:
+            raise calls["failures"].pop(0)
+        return stripe.util.convert_to_stripe_object({"id": "sub_1", "object": "subscription", "status": "active",
+                                                     "customer": "cus_1"})
+
+    monkeypatch.setattr(stripe.PromotionCode, "list", list_promotion_codes)
+    monkeypatch.setattr(stripe.Subscription, "create", create_subscription)
+    return calls
+
+
+def attempt(app, conversion_id):
+    with app.app_context():
+        conversion = main.db.session.get(main.TrialConversion, conversion_id)
+        conversion.due_at = datetime.utcnow() - timedelta(seconds=1)  # skip the backoff
+        main.db.session.commit()
+        try:
+            return main.process_trial_conversion(conversion)
+        except stripe.error.StripeError:
+            return None
+
+
+def test_transient_failure_retries_with_the_same_key_and_parameters(app, conversion_id, stripe_calls):
+    stripe_calls["failures"] = [stripe.error.APIConnectionError("connection reset"),
+                                stripe.error.APIError("server error", http_status=500)]
+    assert attempt(app, conversion_id) is None
+    assert attempt(app, conversion_id) is None
+    assert attempt(app, conversion_id) is True
+
+    first, second, third = stripe_calls["create"]
+    assert first == second == third
+    assert first["idempotency_key"].startswith("trial-")
+    assert first["discounts"] == [{"promotion_code": "promo_1"}]
+    assert stripe_calls["promo_lookups"] == 1
+
+
+def test_definitive_failure_retries_under_a_new_key(app, conversion_id, stripe_calls):
+    stripe_calls["failures"] = [stripe.error.CardError("Your card was declined.", "card", "card_declined",
+                                                       http_status=402)]
+    assert attempt(app, conversion_id) is None
+    assert attempt(app, conversion_id) is True
+
+    declined, retried = stripe_calls["create"]
+    assert retried["idempotency_key"] == declined["idempotency_key"] + "-r1"
+    assert retried["discounts"] == declined["discounts"]
+    with app.app_context():
+        conversion = main.db.session.get(main.TrialConversion, conversion_id)
+        assert (conversion.status, conversion.key_revision, conversion.attempts) == ("done", 1, 2)
+
+
+def test_promo_lookup_failure_is_retried_rather_than_dropping_the_discount(app, conversion_id, stripe_calls,
+                                                                           monkeypatch):
+    lookup = stripe.PromotionCode.list
+
+    def flaky_lookup(**kwargs):
+        monkeypatch.setattr(stripe.PromotionCode, "list", lookup)
+        raise stripe.error.APIConnectionError("timed out")
+
+    monkeypatch.setattr(stripe.PromotionCode, "list", flaky_lookup)
+    assert attempt(app, conversion_id) is None
+    assert stripe_calls["create"] == []
+    assert attempt(app, conversion_id) is True
+    assert stripe_calls["create"][0]["discounts"] == [{"promotion_code": "promo_1"}]
@@ -0,0 +1,63 @@
+import time
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(main, "USAGE_EVENT_BUFFER_SIZE", 4)
+    kicks = []
+    monkeypatch.setattr(main, "kick_usage_event_flush", lambda: kicks.append(1))
+    client = main.LLMClient()
+    client.kicks = kicks
+    monkeypatch.setattr(main, "llm_client", client)
+    return client
+
+
+def record(client, *routes):
+    for route in routes:
+        client.record_usage_event(route, "gpt-3.5-turbo", None, None, 10, 2, time.monotonic())
+
+
+def routes(client):
+    return [event["route"] for event in client.usage_events]
+
+
+def test_half_full_buffer_starts_a_flush(client):
+    record(client, "a")
+    assert client.kicks == []
+    record(client, "b")
+    assert client.kicks == [1]
+
+
+def test_full_buffer_counts_new_events_as_dropped_and_keeps_the_queued_ones(client):
+    record(client, "a", "b", "c", "d", "e", "f")
+
+    assert routes(client) == ["a", "b", "c", "d"]
+    assert client.snapshot()["dropped_usage_events"] == 2
+
+
+def test_failed_flush_requeues_without_evicting_newer_events(app, client, monkeypatch):
+    record(client, "a", "b", "c")
+    execute = main.db.session.execute
+    failures = [RuntimeError("database is down")]
+
+    def insert_fails_once(*args, **kwargs):
+        if failures:
+            record(client, "d", "e")  # calls finishing while the insert is in flight
+            raise failures.pop()
+        return execute(*args, **kwargs)
+
+    monkeypatch.setattr(main.db.session, "execute", insert_fails_once)
+    main.flush_usage_events()
+
+    assert routes(client) == ["a", "b", "c", "d", "e"]
+    assert client.snapshot()["dropped_usage_events"] == 0
+
+    main.flush_usage_events()
+    assert routes(client) == []
+    with app.app_context():
+        assert [event.route for event in main.UsageEvent.query.order_by(main.UsageEvent.id)] == \
+            ["a", "b", "c", "d", "e"]
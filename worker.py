@@ -0,0 +1,27 @@
+"""
+Runs the once-per-deployment scheduled jobs (daily update, trial conversion, usage rollup)
+outside the web tier. Start it with `python -m worker` and run the web processes with
+SCHEDULER_MODE=worker. Several workers can run at once; the scheduler lease still picks one.
+"""
+import logging
+import os
+
+os.environ["PROCESS_ROLE"] = "worker"
+
+from apscheduler.schedulers.blocking import BlockingScheduler  # noqa: E402
+
+import main  # noqa: E402
+
+
+def run():
+    scheduler = BlockingScheduler()
+    main.add_leader_jobs(scheduler)
+    logging.info(f"Scheduler worker started as {main.scheduler_lease_holder()}")
+    try:
+        scheduler.start()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+
+
+if __name__ == '__main__':
+    run()